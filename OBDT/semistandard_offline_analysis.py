@@ -4,13 +4,22 @@ from bokeh.plotting import figure
 from bokeh.layouts import gridplot, column
 from bokeh.transform import jitter
 from bokeh.models import formatters
-import threading
 import multiprocessing
 import math
 import numpy as np
 import pandas as pd
 import itertools
 import os 
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'analysis'))
+from packages.hitstore import CHUNK_HITS, HitStoreWriter, load_store
+from packages.ingest import iter_orbit_chunks, first_orbit, load_triggers, expand_inputs
+from packages.unpacker import TRIGGER_BX_NULL
+from packages.orbitindex import time_to_orbit_range
+from packages.parallel import cpu_count, imap_ordered
+from packages.config import geometry_tables, geo_index, GEO_NFPGA, GEO_NCHAN
+from packages.segments import fit_segments
+from packages.events import build_clusters, reduce_events
 
 #                         / z-axis (beam direction)
 #                        .
@@ -59,6 +68,12 @@ zchamb    = 550.  # spacing betweeen chambers in mm
 tDrift    = 15.6  # drift time in bx
 vDrift    = xcell*0.5 / (tDrift*25.) # drift velocity in mm/ns 
 
+# geometry lookup tables indexed by FPGA*512+TDC_CHANNEL (see analysis/packages/config.py)
+# SL = FPGA number (0,1), channels not normalised
+geo_fpga = np.arange(GEO_NFPGA*GEO_NCHAN) // GEO_NCHAN
+geo_chan = np.arange(GEO_NFPGA*GEO_NCHAN) % GEO_NCHAN
+GEO = geometry_tables(np.where(geo_fpga <= 1, geo_fpga, -1), geo_chan, xcell, zcell)
+
 #############################################
 ### DEFINE BOKEH FIGURE (CANVAS EQUIVALENT)
 
@@ -94,6 +109,7 @@ p_tdcchan_SL = {} # channel
 p_tdcrate_SL = {} # channel
 p_tdcmeas_SL = {} # tdc count
 p_time0diff_SL = {} # difference between t0s 
+p_time0fw_SL = {} # difference between software and firmware t0
 p_time0mult_SL = {} # t0 multiplicity
 p_hitsperorbit_SL = {} # nHits per orbit vs orbit number
 p_hitsperorbitclean_SL = {} # nHits per orbit vs orbit number post-cleanup
@@ -153,6 +169,14 @@ for SL in range(0,2):
     x_axis_label="t0 difference for multiple triplets (bx)",
     )
 
+  p_time0fw_SL[SL] = figure(
+    plot_width=450,
+    plot_height=300,
+    title="t0 meantimer - firmware - SL%d" % SL,
+    y_axis_label="orbits",
+    x_axis_label="t0 meantimer - t0 firmware (bx)",
+    )
+
   p_time0mult_SL[SL] = figure(
     plot_width=450,
     plot_height=300,
@@ -236,16 +260,53 @@ for SL in range(0,2):
 
 #############################################
 ### ANALYSIS
-def thisfunction(SL_, allhits_, exclude_):
+### the hits are analysed chunk by chunk: histograms are accumulated with fixed binning and the selected hits
+### are written out after each chunk, so that the memory used does not depend on the number of input files
+MAXSCATTER = 100000   # maximum number of points kept for the per-hit/per-orbit scatter plots
+HISTBINS = {
+  'chan'  : dict(bins=range(0,nchannels+2)),
+  'tdc'   : dict(bins=range(0,32)),
+  'bxns'  : dict(bins=100, range=(-200,800)),
+  't0ns'  : dict(bins=90,  range=(0,3600)),
+  't0diff': dict(bins=150, range=(-5,5)),
+  't0fw'  : dict(bins=100, range=(-5,5)),
+  't0mult': dict(bins=30,  range=(0,30)),
+  'hpo'   : dict(bins=30,  range=(0,30)),
+  'hpoc'  : dict(bins=10,  range=(0,10)),
+  'posx'  : dict(bins=140, range=(-5,30)),
+  'angl'  : dict(bins=100, range=(-0.1,0.1)),
+}
+HISTEDGES = dict((name, np.histogram([], **bins)[1]) for name, bins in HISTBINS.items())
+# selected hits are written to the columnar stores out_df_<SL>/ (see analysis/packages/hitstore.py), indexed by orbit
+# and read back with packages.hitstore.load_store; with --csv they are also exported to out_df_<SL>.csv at the end of
+# the run, with the columns of the CSV files written before the stores (CSV_COLUMNS)
+OUT_DTYPE = np.dtype([('ORBIT_CNT', np.uint32), ('SL', np.int8), ('LAYER', np.uint8), ('WIRE_NUM', np.int16),
+                      ('TDC_CHANNEL_NORM', np.uint16), ('TIMENS', np.float64), ('TIME0', np.float64),
+                      ('X_POS_LEFT', np.float64), ('X_POS_RIGHT', np.float64), ('Z_POS', np.float32)])
+CSV_COLUMNS = [name for name in OUT_DTYPE.names if name != 'ORBIT_CNT']
+
+def newaccumulator():
+  return {
+    'hist'      : dict((name, np.zeros(len(edges)-1, dtype=np.int64)) for name, edges in HISTEDGES.items()),
+    'orbit_min' : None,       # orbit range for the rate computation
+    'orbit_max' : None,
+    'orbit_last': np.nan,     # last orbit of the previous chunk, for the orbit difference
+    'nselected' : 0,          # selected hits written out so far
+    'lastorbits': None,       # selected hits of the last 3 orbits
+    'lastsegs'  : None,       # segments of the last 3 orbits
+    'scatter'   : {'hpo_x':[], 'hpo_y':[], 'odiff_x':[], 'odiff_y':[], 'pos':[]},
+    'npos'      : 0,
+  }
+
+def fillhist(acc_, name, values):
+  acc_['hist'][name] += np.histogram(values, density=False, **HISTBINS[name])[0]
+
+def thisfunction(SL_, allhits_, exclude_, acc_, fwt0_):
   allhits_SL = allhits_[allhits_['SL']==SL_]
-  dfhits = pd.DataFrame(columns=allhits_SL.dtypes.index)
-  dfhits['TIME0'] = None
-  dfhits['TIMENS'] = None
-  dfhits['ANGLE'] = None
-  dfhits['X_POS_LEFT'] = None
-  dfhits['X_POS_RIGHT'] = None
+  selected = []
 
   tzerodiff = []
+  tzerofwdiff = []
   tzeromult = []
   hitperorbit = []
   hitperorbitclean = []
@@ -264,17 +325,25 @@ def thisfunction(SL_, allhits_, exclude_):
 
       hitperorbit.append(df.count())
 
+      # firmware t0 from the trigger primitive tagging this orbit, if any
+      fwtzero = fwt0_.get(orbits)
+      usefw = fwtzero is not None and args.fwt0
+      runmt = not usefw or args.comparet0
+
       # retain orbits with only 3 or more hits
       #if len(df.index)!=4: continue ### bkp for quadruplets
-      if len(df.index)<3: continue
+      if len(df.index)<3 and not usefw: continue
 
       hitperorbitclean.append(df.count())
       
       tzeros = []
       angles = []
-      for permut in list(itertools.permutations(df.index,3)):
-        chantriplet = df.loc[list(permut)]['TDC_CHANNEL_NORM'].tolist()
-        timetriplet = df.loc[list(permut)]['TIME'].tolist()
+      # channels and times of the orbit taken once, the triplets index them by position
+      chans = df['TDC_CHANNEL_NORM'].values.tolist()
+      times = df['TIME'].values.tolist()
+      for permut in (list(itertools.permutations(range(len(df.index)),3)) if runmt else []):
+        chantriplet = [chans[i] for i in permut]
+        timetriplet = [times[i] for i in permut]
         timediffs   = [ abs(x-y) for x,y in itertools.combinations(timetriplet,2) ]
         if VERBOSE > 1:
           print 'found triplet'
@@ -286,7 +355,7 @@ def thisfunction(SL_, allhits_, exclude_):
           if chantriplet in patterns[patt]:
             if VERBOSE > 1:
               print '--> matching pattern'
-              print '   ', df.loc[list(permut)][['TDC_CHANNEL_NORM','BX_COUNTER','TDC_MEAS']]
+              print '   ', df.iloc[list(permut)][['TDC_CHANNEL_NORM','BX_COUNTER','TDC_MEAS']]
               print '   ', patt, meantimereq(patt,timetriplet) 
               print ''
             tzeros.append(meantimereq(patt,timetriplet)[0])
@@ -294,7 +363,8 @@ def thisfunction(SL_, allhits_, exclude_):
         pass
       pass
 
-      tzeromult.append(len(tzeros))
+      if runmt:
+        tzeromult.append(len(tzeros))
 
       # if more than 1 pattern is found, compare them
       #   if all within 1bx               -> assign the mean of them to tzero
@@ -309,6 +379,12 @@ def thisfunction(SL_, allhits_, exclude_):
           tzero = np.mean(tzeros)
           angle = np.mean(angles)
 
+      # compare software and firmware t0, then use the firmware one if requested
+      if fwtzero is not None and tzero>=0:
+        tzerofwdiff.append(tzero - fwtzero)
+      if usefw:
+        tzero = fwtzero
+
       # remove all orbits with no triplets in it 
       if tzero<0: continue
 
@@ -319,27 +395,109 @@ def thisfunction(SL_, allhits_, exclude_):
       df['TIMENS']=(df['TIME']-df['TIME0'])*25
       df['ANGLE']=angle
       # assign hits position (left/right wrt wire)
-      df['X_POS_LEFT']  = ((df['TDC_CHANNEL_NORM']-0.5).floordiv(4) + df['X_POSSHIFT'])*xcell + xcell/2 - df.TIMENS*vDrift
-      df['X_POS_RIGHT'] = ((df['TDC_CHANNEL_NORM']-0.5).floordiv(4) + df['X_POSSHIFT'])*xcell + xcell/2 + df.TIMENS*vDrift
-
-      # add all back to the dataframe of selected hits
-      dfhits = dfhits.append(df,ignore_index=True)
+      df['X_POS_LEFT']  = df['X_WIRE'] - df.TIMENS*vDrift
+      df['X_POS_RIGHT'] = df['X_WIRE'] + df.TIMENS*vDrift
 
-      dfhits_out = dfhits[['SL','LAYER','WIRE_NUM','TDC_CHANNEL_NORM','TIMENS','TIME0','X_POS_LEFT','X_POS_RIGHT','Z_POS']]
-
-      dfhits_out.to_csv('out_df_%d.csv'%SL_)
+      # add all back to the list of selected hits
+      selected.append(df)
 
     pass
   pass
 
-  if dfhits['HEAD'].count() == 0:
+  dfhits = pd.concat(selected, ignore_index=True) if selected else pd.DataFrame(columns=list(allhits_SL.columns)+['TIME0','TIMENS','ANGLE','X_POS_LEFT','X_POS_RIGHT'])
+
+  acc_['nselected'] += len(dfhits)
+
+  # accumulate histograms
+  fillhist(acc_, 'chan',   allhits_SL.TDC_CHANNEL_NORM)
+  fillhist(acc_, 'tdc',    allhits_SL.TDC_MEAS)
+  fillhist(acc_, 'bxns',   dfhits.TIMENS)
+  fillhist(acc_, 't0ns',   dfhits.TIME0)
+  fillhist(acc_, 't0diff', tzerodiff)
+  fillhist(acc_, 't0fw',   tzerofwdiff)
+  fillhist(acc_, 't0mult', tzeromult)
+  fillhist(acc_, 'hpo',    hitperorbit)
+  fillhist(acc_, 'hpoc',   hitperorbitclean)
+  fillhist(acc_, 'posx',   dfhits.TIMENS*vDrift)
+  fillhist(acc_, 'angl',   dfhits.ANGLE)
+
+  scatter = acc_['scatter']
+  if len(allhits_SL):
+    orbit = allhits_SL['ORBIT_CNT'].values.astype(np.int64)
+    acc_['orbit_min'] = min(orbit.min(), acc_['orbit_min']) if acc_['orbit_min'] is not None else orbit.min()
+    acc_['orbit_max'] = max(orbit.max(), acc_['orbit_max']) if acc_['orbit_max'] is not None else orbit.max()
+    if len(scatter['odiff_x']) < MAXSCATTER:
+      counts = allhits_SL.groupby('ORBIT_CNT', as_index=False).count()
+      scatter['hpo_x'] += counts['ORBIT_CNT'].tolist()
+      scatter['hpo_y'] += counts['HEAD'].tolist()
+      scatter['odiff_x'] += orbit.tolist()
+      scatter['odiff_y'] += np.diff(np.r_[acc_['orbit_last'], orbit]).tolist()
+    acc_['orbit_last'] = orbit[-1]
+
+  if acc_['npos'] < MAXSCATTER:
+    scatter['pos'].append(dfhits[['X_POS_LEFT','X_POS_RIGHT','Z_POS']])
+    acc_['npos'] += len(dfhits)
+
+  # fit the segments of all the selected orbits at once, resolving the left/right ambiguity
+  # the hits of an orbit are split in clusters of wires at most one cell apart, one segment per cluster
+  if len(dfhits):
+    clusters = build_clusters(dfhits['X_WIRE'].values, key=dfhits['ORBIT_CNT'].values, gap=xcell)
+    seg = fit_segments(clusters.event, dfhits['X_POS_LEFT'].values, dfhits['X_POS_RIGHT'].values, dfhits['Z_POS'].values)
+    segs = pd.DataFrame({'ORBIT_CNT':reduce_events(clusters, dfhits['ORBIT_CNT'].values, 'first'),
+                         'SLOPE':seg.slope, 'INTERCEPT':seg.intercept, 'CHI2':seg.chi2})
+    segs = segs[np.isfinite(segs.CHI2)]
+    if VERBOSE > 1:
+      print 'SL {}: {} segments fitted out of {} clusters'.format(SL_, len(segs), clusters.nevents)
+    keeplastorbits(acc_, dfhits, segs)
+
+  return dfhits
+
+def keeplastorbits(acc_, dfhits_, segs_):
+  # keep the selected hits and the segments of the last 3 orbits
+  last = pd.concat([acc_['lastorbits'], dfhits_], ignore_index=True) if acc_['lastorbits'] is not None else dfhits_
+  acc_['lastorbits'] = last[last.ORBIT_CNT.isin(last.ORBIT_CNT.unique()[-3:])]
+  last = pd.concat([acc_['lastsegs'], segs_], ignore_index=True) if acc_['lastsegs'] is not None else segs_
+  acc_['lastsegs'] = last[last.ORBIT_CNT.isin(acc_['lastorbits'].ORBIT_CNT.unique())]
+
+def mergeaccumulator(acc_, part_):
+  # add to acc_ the accumulator of the following chunk, with the same result as analysing the chunks in sequence
+  for name in acc_['hist']:
+    acc_['hist'][name] += part_['hist'][name]
+  acc_['nselected'] += part_['nselected']
+  scatter, partscatter = acc_['scatter'], part_['scatter']
+  if part_['orbit_min'] is not None:
+    acc_['orbit_min'] = min(part_['orbit_min'], acc_['orbit_min']) if acc_['orbit_min'] is not None else part_['orbit_min']
+    acc_['orbit_max'] = max(part_['orbit_max'], acc_['orbit_max']) if acc_['orbit_max'] is not None else part_['orbit_max']
+    if len(scatter['odiff_x']) < MAXSCATTER:
+      # the first orbit difference of the chunk is computed with respect to the last orbit of the previous one
+      partscatter['odiff_y'][0] = float(partscatter['odiff_x'][0] - acc_['orbit_last'])
+      for name in ['hpo_x', 'hpo_y', 'odiff_x', 'odiff_y']:
+        scatter[name] += partscatter[name]
+    acc_['orbit_last'] = part_['orbit_last']
+  if acc_['npos'] < MAXSCATTER:
+    scatter['pos'] += partscatter['pos']
+    acc_['npos'] += part_['npos']
+  if part_['lastorbits'] is not None:
+    keeplastorbits(acc_, part_['lastorbits'], part_['lastsegs'])
+
+def analysechunk(SL_, allhits_SL_):
+  # analyse the hits of a SL in a chunk (in a worker process) into a new accumulator
+  # returns the accumulator and the selected hits to be written out
+  acc = newaccumulator()
+  dfhits = thisfunction(SL_, allhits_SL_, args.exclude, acc, fwt0[SL_])
+  return SL_, acc, dfhits[list(OUT_DTYPE.names)]
+
+
+def plotfunction(SL_, acc_):
+  hist = acc_['hist']
+  edges = HISTEDGES
+  if acc_['nselected'] == 0:
       print 'INFO --- No triplet found in this range'
-      dfhits.fillna(method='ffill')
- 
+
   # now plot
-  histchan,    edgeschan    = np.histogram(allhits_SL.TDC_CHANNEL_NORM, density=False, bins=range(0,nchannels+2))  
-  
-  deltat = float(allhits_SL['ORBIT_CNT'].max() - allhits_SL['ORBIT_CNT'].min()) * 25. * 3564. 
+  histchan,    edgeschan    = hist['chan'], edges['chan']
+
+  deltat = float(acc_['orbit_max'] - acc_['orbit_min']) * 25. * 3564. if acc_['orbit_min'] is not None else float('nan')
   if VERBOSE > 1:
    print 'Delta-t (SL {}) = {} ns'.format(SL_, deltat)
   if deltat!=deltat:
@@ -356,21 +514,26 @@ def thisfunction(SL_, allhits_, exclude_):
   somecolors = []
   maxcount = float(max(histchan))
   for c in range(1, nchannels+1):
-      cval = allhits_SL['TDC_CHANNEL_NORM'][allhits_SL['TDC_CHANNEL_NORM']==c].count()/maxcount if maxcount>0 else allhits_SL['TDC_CHANNEL_NORM'][allhits_SL['TDC_CHANNEL_NORM']==c].count()
+      cval = histchan[c]/maxcount if maxcount>0 else histchan[c]
       occ.append(cval)
       somecolors.append("#%02x%02x%02x" % (int(255*(1-cval)), int(255*(1-cval)), int(255*(1-cval))) if cval>0 else '#ffffff')
   
-  histtdc,     edgestdc     = np.histogram(allhits_SL.TDC_MEAS,         density=False, bins=range(0,32))
-
-  histbxns,    edgesbxns    = np.histogram(dfhits.TIMENS,           density=False, bins=100, range=(-200,800))
-  histt0ns,    edgest0ns    = np.histogram(dfhits.TIME0,            density=False, bins=90,  range=(0,3600))
-  histt0diff,  edgest0diff  = np.histogram(tzerodiff,               density=False, bins=150, range=(-5,5))
-  histt0mult,  edgest0mult  = np.histogram(tzeromult,               density=False, bins=30,  range=(0,30))
-  histhpo,     edgeshpo     = np.histogram(hitperorbit,             density=False, bins=30,  range=(0,30))
-  histhpoc,    edgeshpoc    = np.histogram(hitperorbitclean,        density=False, bins=10,  range=(0,10))
-  histposx,    edgesposx    = np.histogram(dfhits.TIMENS*vDrift,    density=False, bins=140, range=(-5,30))
-  histangl,    edgesangl    = np.histogram(dfhits.ANGLE,            density=False, bins=100, range=(-0.1,0.1))
-
+  histtdc,     edgestdc     = hist['tdc'],    edges['tdc']
+
+  histbxns,    edgesbxns    = hist['bxns'],   edges['bxns']
+  histt0ns,    edgest0ns    = hist['t0ns'],   edges['t0ns']
+  histt0diff,  edgest0diff  = hist['t0diff'], edges['t0diff']
+  histt0fw,    edgest0fw    = hist['t0fw'],   edges['t0fw']
+  histt0mult,  edgest0mult  = hist['t0mult'], edges['t0mult']
+  histhpo,     edgeshpo     = hist['hpo'],    edges['hpo']
+  histhpoc,    edgeshpoc    = hist['hpoc'],   edges['hpoc']
+  histposx,    edgesposx    = hist['posx'],   edges['posx']
+  histangl,    edgesangl    = hist['angl'],   edges['angl']
+
+  scatter = acc_['scatter']
+  dfpos = pd.concat(scatter['pos'], ignore_index=True) if scatter['pos'] else pd.DataFrame(columns=['X_POS_LEFT','X_POS_RIGHT','Z_POS'])
+  dfhits = acc_['lastorbits'] if acc_['lastorbits'] is not None else pd.DataFrame(columns=['ORBIT_CNT','TDC_CHANNEL_NORM','X_POS_LEFT','X_POS_RIGHT','Z_POS'])
+  segs   = acc_['lastsegs'] if acc_['lastsegs'] is not None else pd.DataFrame(columns=['ORBIT_CNT','SLOPE','INTERCEPT','CHI2'])
   p_timebox_SL[SL_].quad(top=histbxns,
               bottom=0,
               left=edgesbxns[:-1],
@@ -401,6 +564,11 @@ def thisfunction(SL_, allhits_, exclude_):
               left=edgest0diff[:-1],
               right=edgest0diff[1:])
 
+  p_time0fw_SL[SL_].quad(top=histt0fw,
+              bottom=0,
+              left=edgest0fw[:-1],
+              right=edgest0fw[1:])
+
   p_time0mult_SL[SL_].quad(top=histt0mult,
               bottom=0,
               left=edgest0mult[:-1],
@@ -417,14 +585,14 @@ def thisfunction(SL_, allhits_, exclude_):
               right=edgeshpoc[1:])
 
   p_hitsperorbitnumber_SL[SL_].square(
-              x=(allhits_SL.groupby('ORBIT_CNT', as_index=False).count())['ORBIT_CNT'],
-              y=(allhits_SL.groupby('ORBIT_CNT', as_index=False).count())['HEAD'],
+              x=scatter['hpo_x'],
+              y=scatter['hpo_y'],
               size=5,
               )
 
   p_orbdiffperorbitnumber_SL[SL_].square(
-              x=allhits_SL.ORBIT_CNT.tolist(),
-              y=allhits_SL.ORBIT_CNT.diff().tolist(),
+              x=scatter['odiff_x'],
+              y=scatter['odiff_y'],
               size=5,
               )
 
@@ -453,14 +621,14 @@ def thisfunction(SL_, allhits_, exclude_):
             fill_color='white',
             line_color='black',
             )
-  p_pos_SL[SL_].scatter(x=dfhits.X_POS_RIGHT,
-            y=dfhits.Z_POS,
+  p_pos_SL[SL_].scatter(x=dfpos.X_POS_RIGHT,
+            y=dfpos.Z_POS,
             # alpha=0.1,
             marker='square',
             size=2,
            )
-  p_pos_SL[SL_].scatter(x=dfhits.X_POS_LEFT,
-            y=dfhits.Z_POS,
+  p_pos_SL[SL_].scatter(x=dfpos.X_POS_LEFT,
+            y=dfpos.Z_POS,
             # alpha=0.1,
             marker='square',
             size=2,
@@ -494,33 +662,19 @@ def thisfunction(SL_, allhits_, exclude_):
               fill_color=colors[0],
               size=5,
              )
-    # minresidual = 9e9
-    # bestfit     = None
-    # for iii in range(0,len(q['X_POS_LEFT'].tolist())/2+1):
-    #   xpos = q['X_POS_LEFT'].tolist()[iii:]+q['X_POS_RIGHT'].tolist()[:iii]
-    #   ypos = q['Z_POS'].tolist()[iii:]+q['Z_POS'].tolist()[:iii]
-    #   regression, residuals, _, _, _ = np.polyfit(ypos, xpos, 1, full=True)
-    #   if residuals<minresidual:
-    #     bestfit = regression
-    #   if VERBOSE > 1:
-    #     print q[['TDC_CHANNEL_NORM','TIMENS','X_POS_LEFT','X_POS_RIGHT','Z_POS', 'ANGLE']]
-    #     print 'x = {}*y + {}'.format(regression[0],regression[1])
-    # xlow  = bestfit[1]
-    # xhigh = xlow + bestfit[0] * zcell*4
-
-
-    # p_pos_SL[SL_].line([xlow, xhigh], 
-    #            [0., zcell*4],
-    #            color=colors[0], 
-    #            # alpha=0.5, 
-    #            line_width=4,
-    #            )
-    # p_pos_SL[SL_].line([xlow, xhigh], 
-    #            [0., zcell*4],
-    #            color=colors[0], 
-    #            # alpha=0.5, 
-    #            line_width=4,
-    #            )
+    fit = segs[segs.ORBIT_CNT == iorbit]
+    if VERBOSE > 1:
+      print q[['TDC_CHANNEL_NORM','TIMENS','X_POS_LEFT','X_POS_RIGHT','Z_POS', 'ANGLE']]
+      print fit
+    for slope, intercept in zip(fit.SLOPE, fit.INTERCEPT):
+      xlow  = intercept
+      xhigh = xlow + slope * zcell*4
+      p_pos_SL[SL_].line([xlow, xhigh], 
+                 [0., zcell*4],
+                 color=colors[0], 
+                 # alpha=0.5, 
+                 line_width=4,
+                 )
 
     colors.pop(0)
 
@@ -599,12 +753,21 @@ patterns['ABD'] += [[1+x, x-1,   x] for x in range(0,nchannels,4) ]
 #############################################
 ### INPUT ARGUMENTS 
 import argparse
-parser = argparse.ArgumentParser(description='Offline analysis of unpacked data. t0 id performed based on pattern matching.')
-parser.add_argument('-i', '--input',  metavar='FILE', help='The unpacked input file to analyze', nargs='+')
+parser = argparse.ArgumentParser(description='Offline analysis of unpacked data. t0 id performed based on pattern matching. '
+                                 'The selected hits of each SL are written to the hit store folder out_df_<SL>/, read with '
+                                 'analysis/packages/hitstore.py load_store (e.g. load_store(\'out_df_0\')), and to out_df_<SL>.csv with --csv.')
+parser.add_argument('-i', '--input',  metavar='FILE', help='The input file to analyze (unpacked .txt, raw .dat, hit store folder or RunNNNNNN folder)', nargs='+')
 parser.add_argument('-n', '--number', action='store', default=-1,  dest='number', type=int, help='Number of hits to analyze')
 parser.add_argument('-x', '--exclude',action='store_true', dest='exclude', help='Exclude meantimer')
+parser.add_argument('-c', '--chunk',  action='store', default=CHUNK_HITS, dest='chunk', type=int, help='Number of hits read and analyzed at once')
+parser.add_argument('-o', '--orbit-range', action='store', default=None, dest='orbit_range', type=int,   nargs=2, metavar=('FIRST','LAST'),  help='Analyze only the orbits in this range (included)')
+parser.add_argument('-f', '--firmware-t0', action='store_true', dest='fwt0',      help='Use the t0 of the firmware trigger primitives (TAGBX) when available, skipping the meantimer (trigger SL = analysis SL)')
+parser.add_argument('-F', '--compare-t0',  action='store_true', dest='comparet0', help='Run the meantimer also on orbits with firmware t0 and histogram the difference')
+parser.add_argument('-j', '--jobs',   action='store', default=1,  dest='jobs',   type=int, help='Number of processes decoding the input files')
+parser.add_argument('-p', '--processes', action='store', default=cpu_count(), dest='processes', type=int, help='Number of processes analysing the (chunk, SL) jobs, 1 to analyse them in this process')
+parser.add_argument('-s', '--csv',    action='store_true', dest='csv', help='Also export the selected hits of each SL from the store out_df_<SL>/ to out_df_<SL>.csv (columns %s)' % ','.join(CSV_COLUMNS))
+parser.add_argument('-t', '--time-window', action='store', default=None, dest='time_window', type=float, nargs=2, metavar=('START','STOP'), help='Analyze only the hits in this time window, in s from the first hit of the first input')
 args = parser.parse_args()
-thesehits = []
 for file_path in args.input:
   if not os.path.exists(os.path.expandvars(file_path)):
       print '--- ERROR ---'
@@ -612,91 +775,132 @@ for file_path in args.input:
       print '  please point to the correct path to the file containing the unpacked data' 
       print 
       exit()
-
-  thesehits.append(pd.read_csv(file_path, skiprows = range(1,131073) if 'data_000000' in file_path else [], skipfooter=1))
+args.input = expand_inputs(args.input)
 print args.input
 
+# orbit range to analyze, read through the orbit index of the input files
+orbit_range = args.orbit_range
+if args.time_window is not None:
+  orbit_range = time_to_orbit_range(first_orbit(args.input[0]), args.time_window)
+if orbit_range is not None:
+  print 'analyzing orbits', orbit_range
+
+# firmware t0 per SL, as {TAGORB: TAGBX}, from the trigger words of the input (null triggers removed)
+fwt0 = dict((SL, {}) for SL in range(2))
+if args.fwt0 or args.comparet0:
+  triggers = load_triggers(args.input, orbit_range)
+  triggers = triggers[triggers['BX'] != TRIGGER_BX_NULL].sort_values('QUAL', ascending=False, kind='mergesort')
+  triggers = triggers.drop_duplicates(['SL','TAGORB'])
+  print 'firmware trigger words           = ', len(triggers)
+  for SL in fwt0:
+    fwt0[SL] = dict(zip(triggers.loc[triggers['SL']==SL, 'TAGORB'].astype(np.int64), triggers.loc[triggers['SL']==SL, 'TAGBX'].astype(np.float64)))
+
 
 #############################################
 ### DATA INGESTION
-# pandas dataframe from csv file
-allhits=pd.concat(thesehits, ignore_index=True)
-
-print 'ALL HITS                         = ', len(allhits)
-print 'ALL HITS [HEAD==0]               = ', len(allhits[allhits.HEAD == 0])
-# retain all words with HEAD=1
-allhits=allhits[allhits.HEAD == 1]
-print 'ALL HITS [HEAD==1]               = ', len(allhits)
-print 'ALL HITS [HEAD==1 & TDC_MEAS==0] = ', len(allhits[allhits.TDC_MEAS==0])
-
-print allhits[allhits.TDC_MEAS==0].head(20)
-
-print allhits[allhits.TDC_MEAS==30].head(20)
-
-if args.number > 0:
-  allhits=allhits.head(args.number)
-
-# append columns depending on the TDC_CHANNEL value
-#
-# conditions  = TDC_CHANNEL % 4
-# X_CHSHIFT  <- chanshift_x = channel shift in X with respect to TDC_CHANNEL, used to plot occupancy
-# LAYER      <- layer_z     = layer
-# Z_POS      <- pos_z       = geometrical wire position in z (assuming 13mm wire-to-wire distance)
-# X_POSSHIFT <- posshift_x  = shift in x position (0.5 = half a cell to the right) to correct for staggering (assuming 42mm wire-to-wire distance)
-conditions  = [ (allhits['TDC_CHANNEL'] % 4 == 1 ),  (allhits['TDC_CHANNEL'] % 4 == 2 ), (allhits['TDC_CHANNEL'] % 4 == 3 ), (allhits['TDC_CHANNEL'] % 4 == 0 ),]
-chanshift_x = [                                  0,                                  -1,                                  0,                                 -1,]
-layer_z     = [                                  1,                                   3,                                  2,                                  4,]
-pos_z       = [                          zcell*3.5,                           zcell*1.5,                          zcell*2.5,                          zcell*0.5,]
-posshift_x  = [                                  0,                                   0,                                0.5,                                0.5,]
-allhits['LAYER']      = np.select(conditions, layer_z,      default=0)
-allhits['X_CHSHIFT']  = np.select(conditions, chanshift_x,  default=0)
-allhits['X_POSSHIFT'] = np.select(conditions, posshift_x,   default=0)
-allhits['Z_POS']      = np.select(conditions, pos_z,        default=0)
-
-# conditions  = FPGA number and TDC_CHANNEL in range
-# SL         <- superlayer = chamber number from 0 to 3 (0,1 FPGA#0 --- 2,3 FPGA#1)
-conditions_SL  = [ (allhits['FPGA'] == 0),  (allhits['FPGA'] == 1),]
-superlayer_SL  = [                      0,                      1, ]
-allhits['SL']         = np.select(conditions_SL, superlayer_SL,      default=-1)
-
-# define time within the orbit (in bx) : BX + TDC/30
-allhits['TIME'] = allhits['BX_COUNTER'] + allhits['TDC_MEAS']/30.
-
-# define channel within SL
-allhits['TDC_CHANNEL_NORM']  = allhits['TDC_CHANNEL']
-allhits['WIRE_NUM']  = (allhits['TDC_CHANNEL_NORM']-1).floordiv(4) + 1
+# hits are read in chunks of about CHUNK hits, never splitting an orbit (see analysis/packages/ingest.py),
+# skipping the first words of the first file of the run (.txt, .dat and hit stores are supported)
+
+def addcolumns(allhits):
+  # append the geometry columns, gathered from the lookup tables with index FPGA*512+TDC_CHANNEL
+  #
+  # X_CHSHIFT  = channel shift in X with respect to TDC_CHANNEL, used to plot occupancy
+  # LAYER      = layer
+  # Z_POS      = geometrical wire position in z (assuming 13mm wire-to-wire distance)
+  # X_POSSHIFT = shift in x position (0.5 = half a cell to the right) to correct for staggering (assuming 42mm wire-to-wire distance)
+  # X_WIRE     = wire position in x
+  # SL         = superlayer = FPGA number
+  # the narrow dtypes of the tables are widened to int64/float64, so that the frame keeps one block per kind
+  index = geo_index(allhits['FPGA'].values, allhits['TDC_CHANNEL'].values)
+  for name in ['LAYER', 'X_CHSHIFT', 'X_POSSHIFT', 'Z_POS', 'X_WIRE', 'SL']:
+    allhits[name] = GEO[name][index].astype(np.int64 if GEO[name].dtype.kind in 'iu' else np.float64)
+
+  # define time within the orbit (in bx) : BX + TDC/30
+  allhits['TIME'] = allhits['BX_COUNTER'] + allhits['TDC_MEAS']/30.
+
+  # define channel within SL
+  allhits['TDC_CHANNEL_NORM']  = allhits['TDC_CHANNEL']
+  allhits['WIRE_NUM']  = (allhits['TDC_CHANNEL_NORM']-1).floordiv(4) + 1
+  return allhits
+
 
 #############################################
 ### DATA HANDLING 
 
-if VERBOSE:
-  print ''
-  print 'dataframe size                   :', allhits['HEAD'].count()
-  print ''
-
-# remove the trigger words from computation
-#allhits = allhits[(allhits['TDC_CHANNEL'] != 139)]
-
-if VERBOSE:
-  print 'dataframe size (no trigger hits) :', allhits['HEAD'].count()
-  print ''
-  print 'min values in dataframe'
-  print allhits[['TDC_CHANNEL','SL','TDC_CHANNEL_NORM','TDC_MEAS','BX_COUNTER','ORBIT_CNT']].min()
-  print ''
-  print 'max values in dataframe'
-  print allhits[['TDC_CHANNEL','SL','TDC_CHANNEL_NORM','TDC_MEAS','BX_COUNTER','ORBIT_CNT']].max()
-  print ''
-  
-jobs = []  
+counters = dict(all=0, head0=0, head1=0, tdc0=0)
+accumulators = dict((SL, newaccumulator()) for SL in range(2))
+writers = dict((SL, HitStoreWriter('out_df_%d' % SL, OUT_DTYPE)) for SL in range(2))
+nanalyzed = 0
 
-for SL in range(2):
-  p = threading.Thread(target=thisfunction, args=(SL,allhits,args.exclude,))
-  jobs.append(p)
-  p.start()
+def chunkjobs():
+  # read the input chunk by chunk and yield the hits of each SL, the jobs analysed by the process pool
+  global nanalyzed
+  for ichunk, allhits in enumerate(iter_orbit_chunks(args.input, args.chunk, orbit_range, args.jobs)):
+
+    counters['all']   += len(allhits)
+    counters['head0'] += len(allhits[allhits.HEAD == 0])
+    # retain all words with HEAD=1
+    allhits=allhits[allhits.HEAD == 1]
+    counters['head1'] += len(allhits)
+    counters['tdc0']  += len(allhits[allhits.TDC_MEAS==0])
+
+    if ichunk == 0:
+      print allhits[allhits.TDC_MEAS==0].head(20)
+
+      print allhits[allhits.TDC_MEAS==30].head(20)
+
+    if args.number > 0:
+      allhits=allhits.head(args.number - nanalyzed)
+    nanalyzed += len(allhits)
+
+    allhits = addcolumns(allhits)
+
+    if VERBOSE:
+      print ''
+      print 'chunk %d: dataframe size          :' % ichunk, allhits['HEAD'].count()
+
+    # remove the trigger words from computation
+    #allhits = allhits[(allhits['TDC_CHANNEL'] != 139)]
+
+    if VERBOSE > 1:
+      print 'dataframe size (no trigger hits) :', allhits['HEAD'].count()
+      print ''
+      print 'min values in dataframe'
+      print allhits[['TDC_CHANNEL','SL','TDC_CHANNEL_NORM','TDC_MEAS','BX_COUNTER','ORBIT_CNT']].min()
+      print ''
+      print 'max values in dataframe'
+      print allhits[['TDC_CHANNEL','SL','TDC_CHANNEL_NORM','TDC_MEAS','BX_COUNTER','ORBIT_CNT']].max()
+      print ''
 
-for pj in jobs:
-  pj.join()
+    for SL in range(2):
+      yield SL, allhits[allhits['SL']==SL]
 
+    if args.number > 0 and nanalyzed >= args.number:
+      break
+
+# the (chunk, SL) jobs are analysed by a pool of processes (in this process with -p 1), the accumulators of the
+# chunks and the selected hits are then merged and written out in order
+for SL, acc, dfhits in imap_ordered(analysechunk, chunkjobs(), args.processes):
+  mergeaccumulator(accumulators[SL], acc)
+  writers[SL].append(dfhits)
+
+print ''
+print 'ALL HITS                         = ', counters['all']
+print 'ALL HITS [HEAD==0]               = ', counters['head0']
+print 'ALL HITS [HEAD==1]               = ', counters['head1']
+print 'ALL HITS [HEAD==1 & TDC_MEAS==0] = ', counters['tdc0']
+print ''
+
+for SL in range(2):
+  writers[SL].close()
+  print 'selected hits SL {}               = '.format(SL), writers[SL].nhits, '(written to the hit store {}/, read with load_store)'.format(writers[SL].path)
+  if args.csv:
+    load_store(writers[SL].path, columns=CSV_COLUMNS).to_csv('{}.csv'.format(writers[SL].path))
+    print '                                   (exported to {}.csv)'.format(writers[SL].path)
+print ''
+
+for SL in range(2):
+  plotfunction(SL, accumulators[SL])
 
 print 'done looping over individual orbits'
 print 'now plotting...'
@@ -717,6 +921,7 @@ show(gridplot([p_tdcchan_SL[0], p_tdcchan_SL[1],],# p_tdcchan_SL[2], p_tdcchan_S
               [p_timebox_SL[0], p_timebox_SL[1],],# p_timebox_SL[2], p_timebox_SL[3]],               # timebox per SL
               [p_time0mult_SL[0], p_time0mult_SL[1],],# p_time0mult_SL[2], p_time0mult_SL[3]],       # meantimer solution (t0) multiplicity per orbit 
               [p_time0diff_SL[0], p_time0diff_SL[1],],# p_time0diff_SL[2], p_time0diff_SL[3]],       # difference of meantimer solution (t0) in case of multiple solutions  
+              [p_time0fw_SL[0], p_time0fw_SL[1],],                                                   # difference between meantimer and firmware t0
               # [p_hitsperorbitnumber_SL[0], p_hitsperorbitnumber_SL[1],],
               # [p_hitsperorbitnumber_SL[2], p_hitsperorbitnumber_SL[3],],                          # multiplicity of hits per orbit
               #[p_orbdiffperorbitnumber_SL[0], p_orbdiffperorbitnumber_SL[1],],
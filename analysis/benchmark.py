@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""Benchmark the stages of the analysis on a recorded run and on replicas of it, storing the results as JSON"""
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import numpy as np
+import pandas as pd
+from packages.ingest import read_file
+from packages.benchmark import data_files, run_isolated, STAGES, INGEST_STAGES, SCALES, BATCH_HITS
+from packages.parallel import cpu_count
+
+ALL_STAGES = list(INGEST_STAGES) + list(STAGES)
+
+# options
+import argparse
+parser = argparse.ArgumentParser(description='Time the stages of the analysis on a recorded run and on orbit-shifted replicas of it.')
+parser.add_argument('-i', '--input',   metavar='PATH', nargs='+', default=['../DAQ/data/Run000591'],            help='RunNNNNNN folders or data files')
+parser.add_argument('-s', '--scales',  metavar='N', nargs='+', type=int, default=SCALES, dest='SCALES',          help='Number of copies of the run')
+parser.add_argument('-t', '--stages',  metavar='STAGE', nargs='+', default=ALL_STAGES, dest='STAGES', choices=ALL_STAGES, help='Stages to time')
+parser.add_argument('-b', '--batch',   action='store', default=BATCH_HITS, dest='BATCH', type=int,              help='Number of hits per batch of the replicas')
+parser.add_argument('-j', '--jobs',    action='store', default=1, dest='JOBS', type=int,                        help='Number of worker processes of the meantimer pool')
+parser.add_argument('-o', '--output',  metavar='FILE', default=None,                                            help='JSON file of the results (default: benchmark_<date>_<time>.json)')
+parser.add_argument('-c', '--compare', metavar='FILE', default=None,                                            help='JSON file of a previous benchmark to compare with')
+args = parser.parse_args()
+
+def git_commit():
+  # commit of the analysis code, None outside of a git repository
+  try:
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+# hits of the run, replicated by the stages of the analysis
+files = data_files(args.input, '.dat') or data_files(args.input, '.txt')
+if not files:
+  sys.exit('no data files in %s' % ' '.join(args.input))
+hits = pd.concat([read_file(f) for f in files], ignore_index=True)
+print('%d hits in %d files, scales %s, batches of %d hits' % (len(hits), len(files), ' '.join(map(str, args.SCALES)), args.BATCH))
+
+results = []
+print('%-18s %6s %12s %12s %12s %10s %10s' % ('stage', 'scale', 'hits', 'hits/s', 'events/s', 'time (s)', 'RSS (MB)'))
+for stage in args.STAGES:
+  for scale in args.SCALES:
+    result = run_isolated(stage, hits, args.input, scale, args.BATCH, args.JOBS)
+    results.append(result)
+    print('%-18s %6d %12d %12.4g %12s %10.3f %10.1f' % (stage, scale, result['hits'], result['hits_per_s'] or 0,
+          '%.4g' % result['events_per_s'] if result['events_per_s'] is not None else '-', result['seconds'], result['peak_rss_mb']))
+
+benchmark = dict(date=time.strftime('%Y-%m-%d %H:%M:%S'), commit=git_commit(), host=platform.node(),
+                 python=platform.python_version(), numpy=np.__version__, pandas=pd.__version__, cpus=cpu_count(),
+                 inputs=args.input, nhits=len(hits), batch_hits=args.BATCH, jobs=args.JOBS, results=results)
+output = args.output
+if output is None:
+  output = time.strftime('benchmark_%Y%m%d_%H%M%S.json')
+with open(output, 'w') as f:
+  json.dump(benchmark, f, indent=1, sort_keys=True)
+print('results saved in %s' % output)
+
+# ratio of the throughputs to those of a previous benchmark, > 1 = faster now
+if args.compare:
+  with open(args.compare) as f:
+    previous = json.load(f)
+  before = dict(((r['stage'], r['scale']), r) for r in previous['results'])
+  print('compared with %s (commit %s, %s)' % (args.compare, previous.get('commit'), previous.get('date')))
+  print('%-18s %6s %14s %14s' % ('stage', 'scale', 'hits/s ratio', 'RSS ratio'))
+  for result in results:
+    old = before.get((result['stage'], result['scale']))
+    if old is None or not old['hits_per_s'] or not result['hits_per_s']:
+      continue
+    print('%-18s %6d %14.3f %14.3f' % (result['stage'], result['scale'], result['hits_per_s'] / old['hits_per_s'],
+          result['peak_rss_mb'] / old['peak_rss_mb']))
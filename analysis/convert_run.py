@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+"""Convert the data files of one or more RunNNNNNN folders into columnar hit stores"""
+import os
+from packages.hitstore import convert_run, load_meta, CHUNK_HITS, STORE_DIRNAME
+from packages.parallel import cpu_count
+
+# options
+import argparse
+parser = argparse.ArgumentParser(description='Convert the .dat/.txt files of RunNNNNNN folders into columnar hit stores.')
+parser.add_argument('-i', '--input',  metavar='DIR', nargs='+', default=['../DAQ/data'],            help='RunNNNNNN folders, or folders containing them')
+parser.add_argument('-o', '--output', metavar='DIR', default=None,                                  help='Output folder for the stores (default: inside each run folder)')
+parser.add_argument('-c', '--chunk',  action='store', default=CHUNK_HITS, dest='CHUNK', type=int,  help='Number of hits per chunk')
+parser.add_argument('-f', '--force',  action='store_true', default=False, dest='FORCE',             help='Overwrite existing stores')
+parser.add_argument('-j', '--jobs',   action='store', default=cpu_count(), dest='JOBS', type=int,   help='Number of processes decoding the files')
+args = parser.parse_args()
+
+# collect run folders
+runs = []
+for path in args.input:
+  if os.path.basename(os.path.normpath(path)).startswith('Run'):
+    runs.append(path)
+  else:
+    runs += sorted(os.path.join(path, d) for d in os.listdir(path) if d.startswith('Run') and os.path.isdir(os.path.join(path, d)))
+
+for run_dir in runs:
+  run = os.path.basename(os.path.normpath(run_dir))
+  output = os.path.join(args.output, run) if args.output else os.path.join(run_dir, STORE_DIRNAME)
+  if os.path.exists(output) and not args.FORCE:
+    print('%s: store %s already exists, skipping' % (run, output))
+    continue
+  convert_run(run_dir, output, chunk_hits=args.CHUNK, verbose=True, processes=args.JOBS)
+  meta = load_meta(output)
+  print('%s: %d hits in %d chunks -> %s' % (run, meta['nhits'], len(meta['chunks']), output))
@@ -0,0 +1,193 @@
+"""BENCHMARK OF THE ANALYSIS STAGES
+Each stage of the online analysis (monitor.py) and of the ingestion is timed on the hits of a recorded run, and on
+replicas of it scaled 10x-1000x: the copies of the hits are shifted by the orbit span of the run, so that they are
+new orbits and events, and are processed in batches of batch_hits hits as the messages of the monitor. The ingestion
+stages read the data files scale times.
+Every (stage, scale) is measured in a child process, so that the peak RSS (ru_maxrss) is not that of the stages run
+before, and the results are dicts that can be stored as JSON and compared between runs:
+
+    stage, scale, batches, hits, events, seconds, hits_per_s, events_per_s, peak_rss_mb
+"""
+
+import os
+import sys
+import time
+import resource
+import multiprocessing
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from unpacker import HIT_COLUMNS
+from ingest import read_file
+from kafkapayload import encode, decode
+from meantimer import MeantimerPool
+from monitor import occupancy_rates, hit_table, event_time0, hit_positions, segments_tracks
+from replay import occupancy_counts
+
+
+BATCH_HITS = 1 << 18          # hits per batch of the replicas
+SCALES     = [1, 10, 100, 1000]
+
+
+############################################# REPLICAS
+def data_files(paths, extension):
+    """Function returning the data files with extension ('.dat' or '.txt') of a list of RunNNNNNN folders and files"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(os.path.join(path, f) for f in os.listdir(path)
+                            if f.startswith('data_') and f.endswith(extension))
+        elif path.endswith(extension):
+            files.append(path)
+    return files
+
+
+def replica_batches(hits, scale, batch_hits=BATCH_HITS):
+    """Generator of the DataFrames of scale copies of hits, each shifted by the orbit span of hits, in batches of
+    whole copies of about batch_hits hits (at least one copy per batch)
+    """
+    if len(hits) == 0:
+        return
+    orbit = hits['ORBIT_CNT'].values.astype(np.int64)
+    span = int(orbit.max() - orbit.min() + 1)
+    per_batch = max(batch_hits // len(hits), 1)
+    for first in range(0, scale, per_batch):
+        copies = min(per_batch, scale - first)
+        batch = pd.DataFrame(dict((name, np.tile(hits[name].values, copies)) for name in HIT_COLUMNS),
+                             columns=HIT_COLUMNS)
+        shift = np.repeat(np.arange(first, first + copies, dtype=np.int64)*span, len(hits))
+        batch['ORBIT_CNT'] = (np.tile(orbit, copies) + shift).astype(hits['ORBIT_CNT'].dtype)
+        yield batch
+
+
+def peak_rss_mb():
+    """Function returning the peak resident memory of this process in MB"""
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 1e6 if sys.platform == 'darwin' else maxrss / 1e3
+
+
+############################################# STAGES
+# prepare(batch, pool) returns the arguments of the stage, untimed, and the stage returns the number of events of the
+# batch (None if the stage has no events)
+def _columns(batch, pool):
+    return (dict((name, batch[name].values) for name in HIT_COLUMNS),)
+
+
+def _columns_pool(batch, pool):
+    return _columns(batch, pool) + (pool,)
+
+
+def _counts(batch, pool):
+    return (occupancy_counts(batch),)
+
+
+def _batch(batch, pool):
+    return (batch,)
+
+
+def _table(batch, pool):
+    return hit_table(_columns(batch, pool)[0]), pool
+
+
+def _positions(batch, pool):
+    allhits = hit_table(_columns(batch, pool)[0])
+    events, tzeros = event_time0(allhits, pool)
+    return hit_positions(allhits), events
+
+
+def _hit_table(columns):
+    hit_table(columns)
+
+
+def _occupancy(counts):
+    occupancy_rates(counts, 1.)
+
+
+def _payload(batch):
+    decode(encode(batch))
+
+
+def _meantimer_results(allhits, pool):
+    return event_time0(allhits, pool)[0].nevents
+
+
+def _segments_tracks(allhits, events):
+    segments_tracks(allhits, events)
+    return events.nevents
+
+
+def _meantimer(columns, pool):
+    allhits = hit_table(columns)
+    events, tzeros = event_time0(allhits, pool)
+    segments_tracks(hit_positions(allhits), events)
+    return events.nevents
+
+
+# name: (prepare, stage)
+STAGES = OrderedDict([
+    ('occupancy',         (_counts,       _occupancy)),          # occupancyPlot message to rates and colours
+    ('payload',           (_batch,        _payload)),            # binary eventsDataframe message, encoded and decoded
+    ('hit_table',         (_columns,      _hit_table)),           # geometry columns and times of the hits
+    ('meantimer_results', (_table,        _meantimer_results)),  # events and their t0 with the meantimer
+    ('segments_tracks',   (_positions,    _segments_tracks)),    # segment fits and cross-chamber tracks
+    ('meantimer',         (_columns_pool, _meantimer)),          # all the analysis of an eventsDataframe message
+])
+INGEST_STAGES = OrderedDict([('ingest_dat', '.dat'), ('ingest_txt', '.txt')])
+
+
+def run_stage(stage, hits, paths, scale=1, batch_hits=BATCH_HITS, processes=1):
+    """Function returning the result dict of a stage (see STAGES and INGEST_STAGES) run at a scale, in this process
+    hits  = DataFrame of the hits of the run (HIT_COLUMNS), replicated scale times
+    paths = RunNNNNNN folders or data files read by the ingestion stages
+    processes = number of workers of the MeantimerPool
+    """
+    result = dict(stage=stage, scale=scale, batches=0, hits=0, events=None, seconds=0.)
+    if stage in INGEST_STAGES:
+        for copy in range(scale):
+            for file_path in data_files(paths, INGEST_STAGES[stage]):
+                start = time.time()
+                df = read_file(file_path)
+                result['seconds'] += time.time() - start
+                result['batches'] += 1
+                result['hits'] += len(df)
+    else:
+        prepare, run = STAGES[stage]
+        pool = MeantimerPool(processes)
+        try:
+            for batch in replica_batches(hits, scale, batch_hits):
+                args = prepare(batch, pool)
+                start = time.time()
+                events = run(*args)
+                result['seconds'] += time.time() - start
+                result['batches'] += 1
+                result['hits'] += len(batch)
+                if events is not None:
+                    result['events'] = (result['events'] or 0) + events
+        finally:
+            pool.close()
+    seconds = result['seconds']
+    result['hits_per_s'] = result['hits'] / seconds if seconds > 0 else None
+    result['events_per_s'] = result['events'] / seconds if seconds > 0 and result['events'] is not None else None
+    result['peak_rss_mb'] = peak_rss_mb()
+    return result
+
+
+def _run_child(queue, args):
+    try:
+        queue.put(run_stage(*args))
+    except Exception as error:
+        queue.put(error)
+
+
+def run_isolated(stage, hits, paths, scale=1, batch_hits=BATCH_HITS, processes=1):
+    """Function returning the result dict of run_stage, run in a child process (forked with the hits already loaded,
+    so that the peak RSS of the child is the memory of the run plus that of the stage)
+    """
+    queue = multiprocessing.Queue()
+    child = multiprocessing.Process(target=_run_child, args=(queue, (stage, hits, paths, scale, batch_hits, processes)))
+    child.start()
+    result = queue.get()
+    child.join()
+    if isinstance(result, Exception):
+        raise result
+    return result
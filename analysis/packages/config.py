@@ -23,7 +23,24 @@ DURATION = {                         # duration in ns of different periods
 }
 TDRIFT    = 15.6*DURATION['bx']    # drift time in ns
 VDRIFT    = XCELL*0.5 / TDRIFT     # drift velocity in mm/ns 
+### Exact time base in TDC ticks (1/30 bx): int64 time used for sorting, grouping and meantimer arithmetic
+TICKS_PER_BX    = 30
+TICKS_PER_ORBIT = DURATION['orbit:bx']*TICKS_PER_BX
+TDRIFT_TICKS    = int(round(TDRIFT / DURATION['tdc']))    # drift time in TDC ticks
+
+def time_ticks(orbit, bx, tdc):
+    """Function returning the int64 time in TDC ticks of arrays of ORBIT_CNT, BX_COUNTER and TDC_MEAS"""
+    return (np.asarray(orbit, dtype=np.int64)*TICKS_PER_ORBIT + np.asarray(bx, dtype=np.int64)*TICKS_PER_BX +
+            np.asarray(tdc, dtype=np.int64))
+
+def ticks_to_ns(ticks):
+    """Function returning a time (or time difference) in TDC ticks converted to ns"""
+    return np.asarray(ticks, dtype=np.float64) * DURATION['tdc']
 TRIGGER_TIME_ARRAY = np.array([DURATION['orbit'], DURATION['bx'], DURATION['tdc']])
+### Cross-chamber tracks: SL 0/2 in the lower chamber, SL 1/3 in the upper one, ZCHAMB above
+SL_ZSHIFT         = [0., ZCHAMB, 0., ZCHAMB]   # z of the bottom of each SL in the global frame (mm)
+TRACK_SL_PAIRS    = [(0, 1), (2, 3)]           # (lower, upper) SLs crossed by the same track
+TRACK_TIME_WINDOW = 2*TICKS_PER_BX             # max t0 difference (ticks) of the segments of a track
 ### Minimum time [bx] between groups of hits with EVENT_NR to be considered as belonging to separate events
 EVENT_TIME_GAP = 1000/DURATION['bx']
 ### Criteria for input hits for meantimer
@@ -62,7 +79,7 @@ grid_t = []
 grid_l = []
 grid_r = []
 for lay in [1,2,3,4]:
-    for cell in range(1,NCHANNELS/4+1):
+    for cell in range(1,NCHANNELS//4+1):
         grid_b.append( 4*ZCELL - lay * ZCELL )
         grid_t.append( grid_b[-1] + ZCELL )
         grid_l.append( (cell-1) * XCELL)
@@ -70,3 +87,50 @@ for lay in [1,2,3,4]:
         if lay%2 == 0:
             grid_l[-1]  += XCELL/2.
             grid_r[-1] += XCELL/2.
+
+### GEOMETRY LOOKUP TABLES ###
+# Dense arrays indexed by FPGA*GEO_NCHAN + TDC_CHANNEL (all the values of the 4+9 bits of the hit words), so that
+# the geometry of a set of hits is a single gather: GEO_LAYER[geo_index(fpga, chan)]
+GEO_NFPGA = 16
+GEO_NCHAN = 512
+
+def geo_index(fpga, chan):
+    """Function returning the index in the geometry lookup tables of arrays of FPGA and TDC_CHANNEL"""
+    return np.asarray(fpga, dtype=np.intp)*GEO_NCHAN + np.asarray(chan, dtype=np.intp)
+
+def geometry_tables(sl, chan_norm, xcell=XCELL, zcell=ZCELL):
+    """Function returning the dict of geometry lookup tables given the SL and normalised channel of each index
+    sl, chan_norm = arrays of GEO_NFPGA*GEO_NCHAN values (SL=-1 for channels not belonging to a chamber)
+    Layer, z position and staggering depend on TDC_CHANNEL % 4, the wire x position on the normalised channel
+    """
+    chan = np.arange(GEO_NFPGA*GEO_NCHAN) % GEO_NCHAN
+    mod = chan % 4                                                # 0, 1, 2, 3
+    posshift = np.array([0.5, 0, 0, 0.5])[mod]
+    return {
+        'SL':               np.asarray(sl).astype(np.int8),
+        'TDC_CHANNEL_NORM': np.asarray(chan_norm).astype(np.uint8),
+        'LAYER':            np.array([4, 1, 3, 2], dtype=np.uint8)[mod],
+        'X_CHSHIFT':        np.array([-1, 0, -1, 0], dtype=np.int8)[mod],
+        'X_POSSHIFT':       posshift.astype(np.float16),
+        'Z_POS':            (np.array([0.5, 3.5, 1.5, 2.5])[mod]*zcell).astype(np.float16),
+        'X_WIRE':           ((np.floor((np.asarray(chan_norm) - 0.5)/4) + posshift)*xcell + xcell/2.).astype(np.float32),
+    }
+
+def _chamber_tables():
+    """Geometry of the chamber setup: SL 0,1 on FPGA 0 and SL 2,3 on FPGA 1, NCHANNELS channels each"""
+    fpga = np.arange(GEO_NFPGA*GEO_NCHAN) // GEO_NCHAN
+    chan = np.arange(GEO_NFPGA*GEO_NCHAN) % GEO_NCHAN
+    sl = np.full(len(chan), -1)
+    for virtex in range(NVIRTEX):
+        sl[(fpga == virtex) & (chan <= NCHANNELS)] = 2*virtex
+        sl[(fpga == virtex) & (chan > NCHANNELS) & (chan <= 2*NCHANNELS)] = 2*virtex + 1
+    return geometry_tables(sl, (chan - NCHANNELS*(sl % 2)) % 256)
+
+GEOMETRY = _chamber_tables()
+GEO_SL               = GEOMETRY['SL']
+GEO_LAYER            = GEOMETRY['LAYER']
+GEO_TDC_CHANNEL_NORM = GEOMETRY['TDC_CHANNEL_NORM']
+GEO_X_CHSHIFT        = GEOMETRY['X_CHSHIFT']
+GEO_X_POSSHIFT       = GEOMETRY['X_POSSHIFT']
+GEO_Z_POS            = GEOMETRY['Z_POS']
+GEO_X_WIRE           = GEOMETRY['X_WIRE']
@@ -0,0 +1,129 @@
+"""BOUNDED KAFKA CONSUMER STAGE
+A thread polls the Kafka consumer in batches (max_records messages, timeout_ms) and feeds a bounded queue read by the
+analysis, so that the memory used is bounded by the queue size whatever the rate of the producers.
+When the analysis lags and the queue fills up, the policy decides what happens to the new messages:
+
+    block  = the polling stops until there is room: nothing is lost, the lag accumulates in Kafka
+    drop   = the oldest queued message is dropped for the new one: the monitor follows the most recent data
+    sample = above half of the queue only one message out of sample is queued, then as drop
+
+The number of messages polled, queued, dropped, the queue depth and the consumer lag (messages behind the end of the
+assigned partitions) are returned by stats()
+"""
+
+import threading
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+
+POLICIES = ('block', 'drop', 'sample')
+
+
+class BoundedConsumer(object):
+    """Consumer stage between a KafkaConsumer and the analysis
+    consumer     = KafkaConsumer (only used by the polling thread once started)
+    maxsize      = max number of messages waiting to be analysed
+    policy       = 'block', 'drop' or 'sample' (see POLICIES)
+    max_records, timeout_ms = max number of messages and max time of each poll
+    sample       = fraction 1/sample of the messages queued by the 'sample' policy when the queue is half full
+    """
+
+    def __init__(self, consumer, maxsize=16, policy='drop', max_records=100, timeout_ms=1000, sample=4):
+        if policy not in POLICIES:
+            raise ValueError('BoundedConsumer: policy must be one of %s' % ', '.join(POLICIES))
+        self.consumer = consumer
+        self.queue = queue.Queue(maxsize)
+        self.policy = policy
+        self.max_records = max_records
+        self.timeout_ms = timeout_ms
+        self.sample = sample
+        self.counts = dict(polled=0, queued=0, dropped=0, sampled_out=0)
+        self.lag = None
+        self.lock = threading.Lock()
+        self.running = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """Start the polling thread"""
+        self.running.set()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stop the polling thread, the messages already queued can still be read"""
+        self.running.clear()
+        if self.thread is not None:
+            self.thread.join()
+
+    def get(self, timeout=None):
+        """Function returning the next message, None if none arrives within timeout (s)"""
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def __iter__(self):
+        while self.running.is_set() or not self.queue.empty():
+            message = self.get(timeout=0.1)
+            if message is not None:
+                yield message
+
+    def stats(self):
+        """Function returning the dict of counters, queue depth and consumer lag"""
+        with self.lock:
+            stats = dict(self.counts)
+        stats['depth'] = self.queue.qsize()
+        stats['lag'] = self.lag
+        return stats
+
+    def _count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def _put(self, message):
+        if self.policy == 'block':
+            while self.running.is_set():
+                try:
+                    self.queue.put(message, timeout=0.1)
+                    self._count('queued')
+                    return
+                except queue.Full:
+                    pass
+            return
+        if self.policy == 'sample' and self.queue.qsize() >= self.queue.maxsize // 2 and \
+           self.counts['polled'] % self.sample:
+            self._count('sampled_out')
+            return
+        while True:
+            try:
+                self.queue.put_nowait(message)
+                self._count('queued')
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self._count('dropped')
+                except queue.Empty:
+                    pass
+
+    def _update_lag(self):
+        lag = 0
+        for partition in self.consumer.assignment():
+            highwater = self.consumer.highwater(partition)
+            if highwater is None:
+                return
+            lag += highwater - self.consumer.position(partition)
+        self.lag = lag
+
+    def _run(self):
+        while self.running.is_set():
+            records = self.consumer.poll(timeout_ms=self.timeout_ms, max_records=self.max_records)
+            for messages in records.values():
+                for message in messages:
+                    self._count('polled')
+                    self._put(message)
+            self._update_lag()
@@ -0,0 +1,97 @@
+"""EVENT BUILDER
+Groups the hits of a whole batch (or run) into events with a single sort: hits are ordered by an optional key
+(e.g. SL) and by time in TDC ticks (see time_ticks in config.py), and a new event starts where the key changes or
+the time difference of consecutive hits is larger than a gap. Since the time is absolute, an event close to the end
+of an orbit continues in the next one.
+The events are returned in CSR layout (hit order and offsets) together with the event id of each hit, so that
+per-event results (e.g. the t0) are computed with one reduction and broadcast back to the hits with one gather.
+The hits are grouped in the same way by position (build_clusters), e.g. the wires of a segment within an orbit
+"""
+
+from collections import namedtuple
+import numpy as np
+from config import TDRIFT_TICKS, TICKS_PER_BX, EVENT_TIME_GAP, XCELL
+
+
+MEANTIMER_GAP     = 1.1*TDRIFT_TICKS                 # max duration of the hits of a track, in TDC ticks
+EVENT_GAP         = EVENT_TIME_GAP*TICKS_PER_BX      # EVENT_TIME_GAP in TDC ticks
+CLUSTER_TOLERANCE = 1e-3                             # tolerance (mm) on the distance of the hits of a cluster
+
+
+class Events(namedtuple('Events', ['order', 'event', 'offsets'])):
+    """Events of a set of hits
+    order   = indices of the hits sorted by event (and by time within each event)
+    event   = event id of each hit, in the input order
+    offsets = the hits of event i are order[offsets[i]:offsets[i+1]]
+    """
+    __slots__ = ()
+
+    @property
+    def nevents(self):
+        return len(self.offsets) - 1
+
+    def sizes(self):
+        """Number of hits of each event"""
+        return np.diff(self.offsets)
+
+
+def _split(values, key, gap):
+    """Function returning the Events of hits sorted by (key, value), split where the key changes or consecutive values
+    differ by more than gap (None to split only on key)
+    """
+    order = np.lexsort((values,) if key is None else (values, np.asarray(key)))
+    new = np.zeros(len(order), dtype=bool)
+    new[:1] = True
+    if key is not None:
+        key = np.asarray(key)[order]
+        new[1:] |= key[1:] != key[:-1]
+    if gap is not None:
+        new[1:] |= np.diff(values[order]) > gap
+    event = np.empty(len(order), dtype=np.int64)
+    event[order] = np.cumsum(new) - 1
+    offsets = np.append(np.flatnonzero(new), len(order))
+    return Events(order, event, offsets)
+
+
+def build_events(ticks, key=None, gap=MEANTIMER_GAP):
+    """Function returning the Events of a set of hits
+    ticks = int64 time of each hit in TDC ticks
+    key   = optional array (e.g. SL, or ORBIT_CNT) whose different values are never in the same event
+    gap   = time difference (ticks) of consecutive hits above which a new event starts, None to split only on key
+    """
+    return _split(np.asarray(ticks, dtype=np.int64), key, gap)
+
+
+def build_clusters(positions, key=None, gap=XCELL):
+    """Function returning the Events of the clusters of hits close in space (e.g. the wires of a segment)
+    positions = float position of each hit in mm (e.g. X_WIRE)
+    key       = optional array (e.g. ORBIT_CNT) whose different values are never in the same cluster
+    gap       = distance (mm) of consecutive hits above which a new cluster starts, up to CLUSTER_TOLERANCE, so that
+                the rounding of the positions does not split hits exactly gap apart
+    """
+    return _split(np.asarray(positions, dtype=np.float64), key, gap + CLUSTER_TOLERANCE)
+
+
+def reduce_events(events, values, how='mean'):
+    """Function returning one value per event from the values of its hits
+    how = 'sum', 'mean', 'min', 'max' or 'first' (first hit in time), NaN for the mean of empty events
+    """
+    values = np.asarray(values)
+    if how in ('sum', 'mean'):
+        total = np.bincount(events.event, weights=values, minlength=events.nevents)
+        if how == 'sum':
+            return total
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return total / events.sizes()
+    if events.nevents == 0:
+        return values[:0]
+    ordered = values[events.order]
+    if how == 'first':
+        return ordered[events.offsets[:-1]]
+    ufunc = {'min': np.minimum, 'max': np.maximum}[how]
+    return ufunc.reduceat(ordered, events.offsets[:-1])
+
+
+def broadcast(events, per_event):
+    """Function returning the per-event values of each hit (a single gather)"""
+    return np.asarray(per_event)[events.event]
@@ -0,0 +1,138 @@
+"""FIXED-BIN HISTOGRAMS ACCUMULATED ACROSS BATCHES
+Histogram keeps integer counts on a fixed uniform binning, filled with a single np.bincount per batch of values,
+so that the monitors show run-integrated distributions without keeping the hits of the previous batches.
+The counts can also follow the recent batches only, with a sliding window of batches or an exponential decay, and
+the partial histograms filled by worker processes are summed with merge.
+Histogram2D bins pairs of values on a fixed (x, y) grid in the same way, e.g. the hit positions in the geometry of a
+SL, so that the size of the plot does not depend on the number of hits
+"""
+
+from collections import deque
+import numpy as np
+
+
+class Histogram(object):
+    """Fixed-bin histogram accumulated across batches
+    bins, range = number of bins and (low, high) edges, with the same binning as np.histogram (values out of range
+                  and NaN are dropped, high belongs to the last bin)
+    window      = number of batches retained (sliding window), None to accumulate all of them
+    decay       = factor by which the counts are multiplied at each new batch (exponential decay), None for none
+    """
+
+    def __init__(self, bins, range, window=None, decay=None):
+        if window is not None and decay is not None:
+            raise ValueError('Histogram: window and decay cannot be used together')
+        self.nbins = int(bins)
+        self.low, self.high = float(range[0]), float(range[1])
+        self.edges = np.linspace(self.low, self.high, self.nbins + 1)
+        self.window = window
+        self.decay = decay
+        self.batches = deque()
+        self.reset()
+
+    def reset(self):
+        """Clear the counts"""
+        self.counts = np.zeros(self.nbins, dtype=np.float64 if self.decay is not None else np.int64)
+        self.batches.clear()
+
+    def bin_index(self, values):
+        """Function returning the bin of each value in range, and the mask of the values in range"""
+        values = np.asarray(values, dtype=np.float64).ravel()
+        with np.errstate(invalid='ignore'):
+            inrange = (values >= self.low) & (values <= self.high)
+        values = values[inrange]
+        index = ((values - self.low) * (self.nbins / (self.high - self.low))).astype(np.intp)
+        index[index == self.nbins] -= 1
+        # same rounding at the bin edges as np.histogram
+        index[values < self.edges[index]] -= 1
+        index[(values >= self.edges[index + 1]) & (index != self.nbins - 1)] += 1
+        return index, inrange
+
+    def count(self, values):
+        """Function returning the counts of a batch of values, without adding them"""
+        return np.bincount(self.bin_index(values)[0], minlength=self.nbins)
+
+    def fill(self, values):
+        """Add a new batch of values"""
+        self.add(self.count(values))
+
+    def add(self, counts):
+        """Add the counts of a new batch, dropping the oldest batch beyond the window or applying the decay"""
+        # a new counts array at each batch, so that the plots holding the previous one see the change
+        counts = np.asarray(counts)
+        if self.decay is not None:
+            self.counts = self.counts*self.decay + counts
+        else:
+            self.counts = self.counts + counts
+        if self.window is not None:
+            self.batches.append(counts)
+            if len(self.batches) > self.window:
+                self.counts -= self.batches.popleft()
+
+    def merge(self, other):
+        """Add the counts of a histogram with the same binning (e.g. filled by a worker) to the current batch"""
+        if other.nbins != self.nbins or other.low != self.low or other.high != self.high:
+            raise ValueError('Histogram: cannot merge histograms with different binning')
+        self.counts = self.counts + other.counts.astype(self.counts.dtype)
+        if self.window is not None:
+            if self.batches:
+                self.batches[-1] = self.batches[-1] + other.counts
+            else:
+                self.batches.append(other.counts.copy())
+
+    def partial(self):
+        """Function returning an empty histogram with the same binning, to be filled by a worker and merged"""
+        return Histogram(self.nbins, (self.low, self.high))
+
+    @property
+    def left(self):
+        return self.edges[:-1]
+
+    @property
+    def right(self):
+        return self.edges[1:]
+
+
+class Histogram2D(Histogram):
+    """Fixed-bin 2D histogram accumulated across batches, counts flattened row by row (y major)
+    xbins, xrange, ybins, yrange = binning of each axis, as for Histogram
+    window, decay = as for Histogram
+    """
+
+    def __init__(self, xbins, xrange, ybins, yrange, window=None, decay=None):
+        self.xaxis = Histogram(xbins, xrange)
+        self.yaxis = Histogram(ybins, yrange)
+        Histogram.__init__(self, self.xaxis.nbins*self.yaxis.nbins, (0, self.xaxis.nbins*self.yaxis.nbins),
+                           window, decay)
+
+    def count(self, x, y):
+        """Function returning the flat counts of a batch of (x, y) values, without adding them"""
+        x, y = np.asarray(x, dtype=np.float64).ravel(), np.asarray(y, dtype=np.float64).ravel()
+        ix, iy = np.full(len(x), -1, dtype=np.intp), np.full(len(y), -1, dtype=np.intp)
+        index, inrange = self.xaxis.bin_index(x)
+        ix[inrange] = index
+        index, inrange = self.yaxis.bin_index(y)
+        iy[inrange] = index
+        inrange = (ix >= 0) & (iy >= 0)
+        return np.bincount(iy[inrange]*self.xaxis.nbins + ix[inrange], minlength=self.nbins)
+
+    def fill(self, x, y):
+        """Add a new batch of (x, y) values"""
+        self.add(self.count(x, y))
+
+    def merge(self, other):
+        """Add the counts of a 2D histogram with the same binning to the current batch"""
+        for axis, other_axis in [(self.xaxis, other.xaxis), (self.yaxis, other.yaxis)]:
+            if other_axis.nbins != axis.nbins or other_axis.low != axis.low or other_axis.high != axis.high:
+                raise ValueError('Histogram2D: cannot merge histograms with different binning')
+        Histogram.merge(self, other)
+
+    def partial(self):
+        """Function returning an empty 2D histogram with the same binning, to be filled by a worker and merged"""
+        return Histogram2D(self.xaxis.nbins, (self.xaxis.low, self.xaxis.high),
+                           self.yaxis.nbins, (self.yaxis.low, self.yaxis.high))
+
+    @property
+    def image(self):
+        # (ybins, xbins) array of the counts, as expected by the image glyph of bokeh
+        return self.counts.reshape(self.yaxis.nbins, self.xaxis.nbins)
@@ -0,0 +1,213 @@
+"""COLUMNAR HIT STORE
+A run is stored as a directory holding one raw little-endian binary file per column (<COLUMN>.bin), with the tight
+dtypes of the unpacker, and a meta.json file describing the columns and the chunks the hits are split into.
+Each chunk is a contiguous range of rows [START, STOP) never splitting an orbit, tagged with its (ORBIT_MIN, ORBIT_MAX)
+so that an orbit range is loaded by reading only the overlapping chunks.
+The firmware trigger words are stored in the same format in the triggers/ subdirectory, chunked by TAGORB
+"""
+
+import os
+import json
+import numpy as np
+import pandas as pd
+from unpacker import HIT_DTYPE, TRIGGER_DTYPE, read_hits_triggers
+from parallel import imap_ordered
+
+
+STORE_DIRNAME = 'hits'        # default name of the store inside a RunNNNNNN folder
+STORE_META    = 'meta.json'
+TRIGGER_DIRNAME = 'triggers'  # sub-store of the trigger words
+STORE_VERSION = 1
+CHUNK_HITS    = 1 << 20       # target number of hits per chunk
+SKIP_FIRST_FILE = 131072      # words skipped at the beginning of data_000000, as done by the offline analysis
+
+
+def chunk_bounds(orbits, chunk_hits=CHUNK_HITS):
+    """Function returning the row boundaries splitting orbits in chunks of about chunk_hits rows
+    Each boundary is moved forward to the first row of the next orbit so that no orbit is split
+    """
+    nhits = len(orbits)
+    bounds = [0]
+    while bounds[-1] + chunk_hits < nhits:
+        start = bounds[-1] + chunk_hits
+        change = np.flatnonzero(orbits[start:] != orbits[start-1])
+        if len(change) == 0:
+            break
+        bounds.append(start + change[0])
+    if bounds[-1] != nhits or nhits == 0:
+        bounds.append(nhits)
+    return bounds
+
+
+class HitStoreWriter(object):
+    """Writer of a columnar hit store
+    path       = directory of the store (created if needed, existing columns are overwritten)
+    dtype      = structured dtype of the rows to be stored (HIT_DTYPE by default)
+    chunk_hits = target number of hits per chunk
+    orbit      = name of the orbit column the chunks are tagged with
+    block_hits = rows buffered before being written, so that many small appends (e.g. the selected hits of each
+                 orbit) result in few large writes and chunks (default: chunk_hits)
+    """
+
+    def __init__(self, path, dtype=HIT_DTYPE, chunk_hits=CHUNK_HITS, orbit='ORBIT_CNT', block_hits=None):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.chunk_hits = chunk_hits
+        self.block_hits = chunk_hits if block_hits is None else block_hits
+        self.orbit = orbit
+        self.chunks = []
+        self.nhits = 0
+        self.sources = []
+        self.buffer = dict((name, []) for name in self.dtype.names)
+        self.nbuffered = 0
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.files = {name: open(os.path.join(path, '%s.bin' % name), 'wb') for name in self.dtype.names}
+
+    def append(self, hits, source=None):
+        """Append a structured array (or DataFrame) of hits, in acquisition order"""
+        if source is not None:
+            self.sources.append(source)
+        if len(hits) == 0:
+            return
+        for name in self.dtype.names:
+            self.buffer[name].append(np.asarray(hits[name]).astype(self.dtype[name].newbyteorder('<'), copy=False))
+        self.nbuffered += len(hits)
+        if self.nbuffered >= self.block_hits:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered hits, split in chunks of about chunk_hits rows"""
+        if self.nbuffered == 0:
+            return
+        columns = {}
+        for name in self.dtype.names:
+            parts = self.buffer[name]
+            columns[name] = parts[0] if len(parts) == 1 else np.concatenate(parts)
+            self.buffer[name] = []
+        orbits = columns[self.orbit]
+        bounds = chunk_bounds(orbits, self.chunk_hits)
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            self.chunks.append([int(orbits[start:stop].min()), int(orbits[start:stop].max()),
+                                self.nhits + start, self.nhits + stop])
+        for name in self.dtype.names:
+            self.files[name].write(np.ascontiguousarray(columns[name]).tobytes())
+        self.nhits += self.nbuffered
+        self.nbuffered = 0
+
+    def close(self):
+        """Write the buffered hits, close the column files and write the meta.json file (the index of the chunks)"""
+        self.flush()
+        for f in self.files.values():
+            f.close()
+        meta = {
+            'version': STORE_VERSION,
+            'nhits':   self.nhits,
+            'orbit':   self.orbit,
+            'columns': [[name, self.dtype[name].newbyteorder('<').str] for name in self.dtype.names],
+            'chunks':  self.chunks,
+            'sources': self.sources,
+        }
+        with open(os.path.join(self.path, STORE_META), 'w') as f:
+            json.dump(meta, f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def is_store(path):
+    """Function returning True if path is a hit store directory"""
+    return os.path.isfile(os.path.join(path, STORE_META))
+
+
+def load_meta(path):
+    """Function returning the content of the meta.json file of a store"""
+    with open(os.path.join(path, STORE_META)) as f:
+        return json.load(f)
+
+
+def select_chunks(chunks, orbit_range=None):
+    """Function returning the chunks overlapping orbit_range = (first, last), both included"""
+    if orbit_range is None:
+        return chunks
+    return [c for c in chunks if c[1] >= orbit_range[0] and c[0] <= orbit_range[1]]
+
+
+def load_store(path, orbit_range=None, columns=None):
+    """Function returning the DataFrame of hits in a store, with the columns of the unpacked files
+    orbit_range = optional (first, last) orbits to retain, both included: only the overlapping chunks are read
+    columns     = optional list of columns to read
+    """
+    meta = load_meta(path)
+    ranges = [(c[2], c[3]) for c in select_chunks(meta['chunks'], orbit_range)]
+    df = load_ranges(path, ranges, columns, meta)
+    orbit = meta.get('orbit', 'ORBIT_CNT')
+    if orbit_range is not None and orbit in df:
+        df = df[df[orbit].between(orbit_range[0], orbit_range[1])].reset_index(drop=True)
+    return df
+
+
+def load_store_triggers(path, orbit_range=None):
+    """Function returning the DataFrame of the trigger words of a store, orbit_range applies to TAGORB"""
+    path = os.path.join(path, TRIGGER_DIRNAME)
+    if not is_store(path):
+        return pd.DataFrame(np.zeros(0, dtype=TRIGGER_DTYPE))
+    return load_store(path, orbit_range)
+
+
+def load_ranges(path, ranges, columns=None, meta=None):
+    """Function returning the DataFrame of the hits in the row ranges [(start, stop), ...] of a store"""
+    if meta is None:
+        meta = load_meta(path)
+    dtypes = [(name, np.dtype(str(dt))) for name, dt in meta['columns']]
+    if columns is not None:
+        dtypes = [(name, dt) for name, dt in dtypes if name in columns]
+    data = {}
+    for name, dt in dtypes:
+        if meta['nhits'] == 0:
+            data[name] = np.zeros(0, dtype=dt)
+            continue
+        column = np.memmap(os.path.join(path, '%s.bin' % name), dtype=dt, mode='r', shape=(meta['nhits'],))
+        data[name] = np.concatenate([column[start:stop] for start, stop in ranges] or [np.zeros(0, dtype=dt)])
+        del column
+    return pd.DataFrame(data, columns=[name for name, _ in dtypes])
+
+
+def run_files(run_dir):
+    """Function returning the sorted data files of a run folder, preferring the raw .dat over the unpacked .txt"""
+    files = sorted(f for f in os.listdir(run_dir) if f.startswith('data_'))
+    dat = [f for f in files if f.endswith('.dat')]
+    txt = [f for f in files if f.endswith('.txt')]
+    return [os.path.join(run_dir, f) for f in (dat if dat else txt)]
+
+
+def read_run_file(file_path):
+    """Function returning the structured arrays (hits, triggers) of a data file of a run, skipping the first words
+    of data_000000 as done by the offline analysis
+    """
+    skip = SKIP_FIRST_FILE if 'data_000000' in os.path.basename(file_path) else 0
+    return read_hits_triggers(file_path, skip)
+
+
+def convert_run(run_dir, output=None, chunk_hits=CHUNK_HITS, verbose=False, processes=1):
+    """Convert all the data files of a RunNNNNNN folder into a hit store (by default RunNNNNNN/hits)
+    processes = number of worker processes decoding the files, which are still written in order
+    Returns the path of the store
+    """
+    if output is None:
+        output = os.path.join(run_dir, STORE_DIRNAME)
+    hitwriter = HitStoreWriter(output, chunk_hits=chunk_hits)
+    trgwriter = HitStoreWriter(os.path.join(output, TRIGGER_DIRNAME), TRIGGER_DTYPE, chunk_hits, orbit='TAGORB')
+    files = run_files(run_dir)
+    for i, (hits, triggers) in enumerate(imap_ordered(read_run_file, [(f,) for f in files], processes)):
+        file_path = files[i]
+        hitwriter.append(hits, source=os.path.basename(file_path))
+        trgwriter.append(triggers, source=os.path.basename(file_path))
+        if verbose:
+            print('%s: %d hits, %d triggers' % (file_path, len(hits), len(triggers)))
+    hitwriter.close()
+    trgwriter.close()
+    return output
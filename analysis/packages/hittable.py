@@ -0,0 +1,93 @@
+"""HIT TABLE WITH LAZY DERIVED COLUMNS
+HitTable keeps the raw fields of the hits (HIT_COLUMNS of the unpacker) as compact NumPy columns and computes the
+derived columns (LAYER, X_CHSHIFT, X_POSSHIFT, Z_POS, SL, TDC_CHANNEL_NORM, X_WIRE, TIME_ABS, TIME_TDC) only when
+they are first accessed, caching them. A step using only the raw fields (e.g. the channel rates) allocates nothing extra.
+The geometry columns are gathered from the lookup tables of config.py with the index FPGA*512+TDC_CHANNEL.
+TIME_TDC is the exact int64 time in TDC ticks, TIME_ABS the float64 time in ns
+"""
+
+import numpy as np
+import pandas as pd
+from config import DURATION, GEOMETRY, geo_index, time_ticks
+from unpacker import HIT_COLUMNS
+
+
+# columns of the Kafka eventsDataframe messages with a different name
+ALIASES = {'TDC_MEANS': 'TDC_MEAS'}
+
+
+############################################# DERIVED COLUMNS
+def _geometry(name):
+    """Derived column gathered from the geometry lookup tables of config.py"""
+    return lambda t: GEOMETRY[name][t['GEO_INDEX']]
+
+
+def _time_abs(t):
+    return (t['ORBIT_CNT'].astype(np.float64)*DURATION['orbit'] +
+            t['BX_COUNTER'].astype(np.float64)*DURATION['bx'] +
+            t['TDC_MEAS'].astype(np.float64)*DURATION['tdc'])
+
+
+def _time_tdc(t):
+    return time_ticks(t['ORBIT_CNT'], t['BX_COUNTER'], t['TDC_MEAS'])
+
+
+DERIVED = dict((name, _geometry(name)) for name in GEOMETRY)
+DERIVED['GEO_INDEX'] = lambda t: geo_index(t['FPGA'], t['TDC_CHANNEL'])
+DERIVED['TIME_ABS']  = _time_abs
+DERIVED['TIME_TDC']  = _time_tdc
+
+
+############################################# TABLE
+class HitTable(object):
+    """Table of hits with raw columns and lazily computed, cached derived columns (see DERIVED)
+    hits = structured array (HIT_DTYPE), DataFrame or dict of columns; TDC_MEANS is accepted for TDC_MEAS
+    """
+
+    def __init__(self, hits):
+        names = hits.dtype.names if isinstance(hits, np.ndarray) else list(hits.keys())
+        self._columns = {}
+        for name in names:
+            self._columns[ALIASES.get(name, name)] = np.ascontiguousarray(hits[name])
+        self._size = len(self._columns[names[0]]) if names else 0
+        self._derived = {}
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, name):
+        return name in self._columns or name in self._derived or name in DERIVED
+
+    def __getitem__(self, name):
+        if name in self._columns:
+            return self._columns[name]
+        if name not in self._derived:
+            if name not in DERIVED:
+                raise KeyError(name)
+            self._derived[name] = DERIVED[name](self)
+        return self._derived[name]
+
+    @property
+    def raw_columns(self):
+        """Names of the raw columns"""
+        return [name for name in HIT_COLUMNS if name in self._columns] + \
+               [name for name in self._columns if name not in HIT_COLUMNS]
+
+    @property
+    def cached_columns(self):
+        """Names of the derived columns computed so far"""
+        return list(self._derived.keys())
+
+    def select(self, mask):
+        """HitTable with the hits selected by a boolean mask or an array of indices, keeping the cached columns"""
+        table = HitTable.__new__(HitTable)
+        table._columns = dict((name, column[mask]) for name, column in self._columns.items())
+        table._derived = dict((name, column[mask]) for name, column in self._derived.items())
+        table._size = len(next(iter(table._columns.values()))) if table._columns else 0
+        return table
+
+    def to_dataframe(self, columns=None):
+        """DataFrame with the given raw and derived columns (default: raw columns and derived columns cached so far)"""
+        if columns is None:
+            columns = self.raw_columns + self.cached_columns
+        return pd.DataFrame(dict((name, self[name]) for name in columns), columns=columns)
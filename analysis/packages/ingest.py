@@ -0,0 +1,127 @@
+"""STREAMING INGESTION OF THE DATA FILES
+Generators reading .dat, .txt files and hit stores in chunks of fixed size, so that the memory needed to
+process a run does not depend on the number of files. The hits of the last orbit of a chunk, which may continue
+in the next chunk or file, are carried over so that every orbit is delivered whole in a single chunk.
+The files can be decoded in parallel by a pool of worker processes, one file per job, keeping the file order
+"""
+
+import os
+import numpy as np
+import pandas as pd
+from unpacker import map_words, unpack, to_dataframe, csv_to_hits, read_csv, read_triggers, TRIGGER_DTYPE, WORD_DTYPE
+from hitstore import is_store, load_meta, load_ranges, load_store, load_store_triggers, run_files, CHUNK_HITS, SKIP_FIRST_FILE
+from orbitindex import read_orbit_range
+from parallel import imap_ordered
+
+
+def expand_inputs(paths):
+    """Function returning the list of files to read from a list of data files, hit stores and RunNNNNNN folders
+    The data files of a run folder (without a hit store given explicitly) are taken in order, see run_files
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path) and not is_store(path):
+            files += run_files(path)
+        else:
+            files.append(path)
+    return files
+
+
+def first_file_skip(file_path):
+    """Function returning the number of words skipped at the beginning of a file, as done by the offline analysis"""
+    return SKIP_FIRST_FILE if 'data_000000' in os.path.basename(file_path) else 0
+
+
+def first_orbit(file_path):
+    """Function returning the orbit of the first hit of a file (after the skipped words), None if empty"""
+    if is_store(file_path):
+        chunks = load_meta(file_path)['chunks']
+        return chunks[0][0] if chunks else None
+    for df in iter_file(file_path):
+        if len(df):
+            return int(df['ORBIT_CNT'].iloc[0])
+    return None
+
+
+def iter_file(file_path, chunk_hits=CHUNK_HITS, orbit_range=None):
+    """Generator of DataFrames of at most chunk_hits hits read sequentially from a .dat, .txt file or hit store
+    orbit_range = optional (first, last) orbits to retain: only the blocks of the file overlapping the range are read,
+                  using the chunks of the hit stores or the orbit index of the data files (see orbitindex.py)
+    """
+    if orbit_range is not None:
+        if is_store(file_path):
+            df = load_store(file_path, orbit_range)
+        else:
+            df = read_orbit_range(file_path, orbit_range, first_file_skip(file_path))
+        for start in range(0, len(df), chunk_hits):
+            yield df.iloc[start:start+chunk_hits].reset_index(drop=True)
+    elif is_store(file_path):
+        meta = load_meta(file_path)
+        for start in range(0, meta['nhits'], chunk_hits):
+            yield load_ranges(file_path, [(start, min(start+chunk_hits, meta['nhits']))], meta=meta)
+    elif file_path.endswith('.dat'):
+        words = map_words(file_path, first_file_skip(file_path))
+        for start in range(0, len(words), chunk_hits):
+            yield to_dataframe(unpack(words[start:start+chunk_hits]))
+    else:
+        for df in read_csv(file_path, first_file_skip(file_path), chunksize=chunk_hits):
+            yield to_dataframe(csv_to_hits(df))
+
+
+def read_file(file_path, orbit_range=None):
+    """Function returning the DataFrame of all the hits of a file (job of the parallel ingestion)"""
+    dfs = list(iter_file(file_path, CHUNK_HITS, orbit_range))
+    if not dfs:
+        return to_dataframe(unpack(np.zeros(0, dtype=WORD_DTYPE)))
+    return dfs[0] if len(dfs) == 1 else pd.concat(dfs, ignore_index=True)
+
+
+def iter_files(files, chunk_hits=CHUNK_HITS, orbit_range=None, processes=1):
+    """Generator of DataFrames of at most chunk_hits hits read from a list of files, in the order of the files
+    processes > 1 = files decoded in a pool of worker processes, with at most 2*processes files in memory
+    """
+    if processes <= 1:
+        for file_path in files:
+            for df in iter_file(file_path, chunk_hits, orbit_range):
+                yield df
+        return
+    for df in imap_ordered(read_file, [(file_path, orbit_range) for file_path in files], processes):
+        for start in range(0, len(df), chunk_hits):
+            yield df.iloc[start:start+chunk_hits].reset_index(drop=True)
+
+
+def iter_orbit_chunks(files, chunk_hits=CHUNK_HITS, orbit_range=None, processes=1):
+    """Generator of DataFrames of about chunk_hits hits read from a list of files, never splitting an orbit
+    The hits with the orbit of the last hit of each chunk are held back and prepended to the next chunk
+    processes = number of worker processes decoding the files (see iter_files)
+    """
+    pending = None
+    for df in iter_files(files, chunk_hits, orbit_range, processes):
+        if pending is not None and len(pending):
+            df = pd.concat([pending, df], ignore_index=True)
+        if len(df) == 0:
+            continue
+        is_open = (df['ORBIT_CNT'] == df['ORBIT_CNT'].iloc[-1]).values
+        pending = df[is_open]
+        if not is_open.all():
+            yield df[~is_open].reset_index(drop=True)
+    if pending is not None and len(pending):
+        yield pending.reset_index(drop=True)
+
+
+def load_triggers(files, orbit_range=None):
+    """Function returning the DataFrame (TRIGGER_COLUMNS) of the firmware trigger words of a list of files
+    orbit_range = optional (first, last) range of the tagged orbit (TAGORB) to retain
+    """
+    dfs = []
+    for file_path in files:
+        if is_store(file_path):
+            df = load_store_triggers(file_path, orbit_range)
+        else:
+            df = to_dataframe(read_triggers(file_path, first_file_skip(file_path)))
+        if orbit_range is not None:
+            df = df[df['TAGORB'].between(orbit_range[0], orbit_range[1])]
+        dfs.append(df)
+    if not dfs:
+        return to_dataframe(np.zeros(0, dtype=TRIGGER_DTYPE))
+    return pd.concat(dfs, ignore_index=True)
@@ -0,0 +1,106 @@
+"""BINARY KAFKA PAYLOAD
+Compact columnar format of the messages of the eventsDataframe (hits) and occupancyPlot (counts per channel) topics,
+replacing the JSON text. A message is a fixed little-endian header, one descriptor per column and the raw column
+arrays, each padded to 8 bytes:
+
+    header     = MAGIC, version (u1), kind (u1), number of columns (u2), run number (u4), number of rows (u4),
+                 batch window start and stop (f8, f8, e.g. unix time in s)                              32 bytes
+    descriptor = column name (16 bytes), NumPy dtype string (8 bytes, e.g. '<u4')                      24 bytes
+    data       = rows * itemsize bytes per column, padded to a multiple of 8 bytes
+
+The decoder returns the columns as np.frombuffer views on the message, without copies; messages that do not start
+with MAGIC are decoded as the JSON of the previous format, so that old and new producers can coexist
+"""
+
+import json
+import struct
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+from unpacker import HIT_DTYPE
+
+
+MAGIC   = b'DTPL'
+VERSION = 1
+HEADER     = struct.Struct('<4sBBHIIdd')
+DESCRIPTOR = struct.Struct('<16s8s')
+ALIGN      = 8
+
+KIND_HITS      = 0
+KIND_OCCUPANCY = 1
+TOPIC_KINDS = {'eventsDataframe': KIND_HITS, 'occupancyPlot': KIND_OCCUPANCY}
+# columns of the two kinds of messages
+OCCUPANCY_DTYPE = np.dtype([('FPGA', np.uint8), ('TDC_CHANNEL', np.uint16), ('COUNT', np.uint32)])
+KIND_DTYPES = {KIND_HITS: HIT_DTYPE, KIND_OCCUPANCY: OCCUPANCY_DTYPE}
+
+
+class Payload(namedtuple('Payload', ['kind', 'run', 'window', 'columns'])):
+    """Decoded message
+    kind    = KIND_HITS or KIND_OCCUPANCY
+    run     = run number
+    window  = (start, stop) of the batch
+    columns = dict of the column arrays (read-only views on the message)
+    """
+    __slots__ = ()
+
+    def __len__(self):
+        return len(next(iter(self.columns.values()))) if self.columns else 0
+
+
+def _padding(nbytes):
+    return -nbytes % ALIGN
+
+
+def encode(rows, kind=KIND_HITS, run=0, window=(0., 0.), names=None):
+    """Function returning the bytes of a message
+    rows  = structured array, DataFrame or dict of columns (by default the columns of KIND_DTYPES[kind] are stored
+            with their dtypes)
+    names = optional list of the columns to store, with the dtype of rows
+    """
+    if names is None and kind in KIND_DTYPES:
+        columns = [(name, np.asarray(rows[name]).astype(KIND_DTYPES[kind][name], copy=False))
+                   for name in KIND_DTYPES[kind].names]
+    else:
+        if names is None:
+            names = rows.dtype.names if isinstance(rows, np.ndarray) else list(rows.keys())
+        columns = [(name, np.asarray(rows[name])) for name in names]
+    nrows = len(columns[0][1]) if columns else 0
+    parts = [HEADER.pack(MAGIC, VERSION, kind, len(columns), run, nrows, window[0], window[1])]
+    data = []
+    for name, column in columns:
+        if column.dtype.kind not in 'biuf' or len(column) != nrows:
+            raise ValueError('encode: column %s must be numeric with %d rows' % (name, nrows))
+        column = column.astype(column.dtype.newbyteorder('<'), copy=False)
+        parts.append(DESCRIPTOR.pack(name.encode('ascii'), column.dtype.str.encode('ascii')))
+        data.append(np.ascontiguousarray(column).tobytes())
+        data.append(b'\0' * _padding(len(data[-1])))
+    return b''.join(parts + data)
+
+
+def decode(message):
+    """Function returning the Payload of the bytes of a message (zero-copy)"""
+    magic, version, kind, ncolumns, run, nrows, start, stop = HEADER.unpack_from(message, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('decode: not a version %d payload' % VERSION)
+    offset = HEADER.size + ncolumns*DESCRIPTOR.size
+    columns = {}
+    for i in range(ncolumns):
+        name, dtype = DESCRIPTOR.unpack_from(message, HEADER.size + i*DESCRIPTOR.size)
+        name, dtype = name.rstrip(b'\0').decode('ascii'), np.dtype(dtype.rstrip(b'\0').decode('ascii'))
+        columns[name] = np.frombuffer(message, dtype=dtype, count=nrows, offset=offset)
+        offset += nrows*dtype.itemsize + _padding(nrows*dtype.itemsize)
+    return Payload(kind, run, (start, stop), columns)
+
+
+def deserialize(message):
+    """Kafka value_deserializer: Payload of a binary message, or the object of a JSON message of the old format"""
+    if message[:len(MAGIC)] == MAGIC:
+        return decode(message)
+    return json.loads(message.decode('ascii'))
+
+
+def message_columns(value):
+    """Function returning the columns of a deserialized message: dict of arrays of a Payload, DataFrame of a JSON one"""
+    if isinstance(value, Payload):
+        return value.columns
+    return pd.DataFrame(value)
@@ -0,0 +1,242 @@
+"""VECTORISED MEANTIMER
+Batch counterpart of meantimer_results: for all the events of a batch at once, every triplet of hits matching one of
+the cell PATTERNS is generated as arrays of hit indices, the meantimer equations (see meantimereq) are solved and
+the MEANTIMER_ANGLES cut is applied in single NumPy operations.
+An event is any group of hits of a single SL (e.g. an orbit, or the hits of an orbit close in time, see time_groups).
+The solutions are returned sorted by event, with the offsets of the solutions of each event (CSR layout).
+Hit times are exact int64 TDC ticks (see time_ticks in config.py): the sums of the equations are done in integers
+and the t0 is a multiple of 1/4 tick, to be converted to ns (ticks_to_ns) only when needed.
+MeantimerPool spreads large batches over long-lived worker processes, sharing the hits through shared memory
+"""
+
+import ctypes
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+from collections import namedtuple
+import numpy as np
+from config import TDRIFT_TICKS, VDRIFT, ZCELL, DURATION, MEANTIMER_ANGLES
+from patterns import PATTERNS, PATTERN_NAMES, TRIPLETS, event_masks, match_patterns
+from events import build_events
+from parallel import cpu_count
+
+
+############################################# PATTERN TABLES
+PATTERN_LIST = sorted(PATTERNS.keys())                      # pattern id = index in this list
+EQ_ABC, EQ_ABD, EQ_ACD = 0, 1, 2                            # ABC and BCD share the same equation
+EQUATIONS = {'ABC': EQ_ABC, 'BCD': EQ_ABC, 'ABD': EQ_ABD, 'ACD': EQ_ACD}
+
+# one row per triplet of channels (patterns.TRIPLETS): channels, pattern id
+TRIPLET_CHANNELS = np.array(TRIPLETS, dtype=np.int64)
+TRIPLET_PATTERN  = np.array([PATTERN_LIST.index(PATTERN_NAMES[triplet]) for triplet in TRIPLETS], dtype=np.int64)
+PATTERN_EQUATION = np.array([EQUATIONS[name[:-1]] for name in PATTERN_LIST], dtype=np.int8)
+PATTERN_SIGN     = np.array([-1. if name[-1] == 'l' else 1. for name in PATTERN_LIST])
+
+ANGLE_MIN = np.array([a[0] for a in MEANTIMER_ANGLES])
+ANGLE_MAX = np.array([a[1] for a in MEANTIMER_ANGLES])
+
+CHANNEL_KEY = 1 << 16         # key of a hit = event * CHANNEL_KEY + channel
+
+
+class MeantimerSolutions(namedtuple('MeantimerSolutions', ['events', 'offsets', 'tzero', 'angle', 'hits', 'pattern'])):
+    """Solutions of the meantimer for a batch of events
+    events  = sorted unique event ids of the batch
+    offsets = the solutions of events[i] are in the range offsets[i]:offsets[i+1]
+    tzero, angle = t0 (in TDC ticks) and angle of each solution
+    hits    = (N, 3) indices of the input hits of each solution, pattern = index in PATTERN_LIST
+    """
+    __slots__ = ()
+
+
+############################################# CANDIDATE TRIPLETS
+def _expand(starts, counts):
+    """Function returning (owner, position) flattening the ranges [starts[i], starts[i]+counts[i])"""
+    owner = np.repeat(np.arange(len(counts)), counts)
+    position = np.arange(owner.size) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(starts, counts)
+    return owner, position
+
+
+def triplet_candidates(event, channel):
+    """Function returning all the triplets of hits of a same event matching a pattern
+    event, channel = arrays with the event id and normalised channel of each hit
+    The matching triplets of channels are found with the uint64 masks of the fired channels of all the events
+    (see patterns.match_patterns), then expanded to all the combinations of hits in those channels
+    Returns (hits, triplet) = (N, 3) indices of the hits and index of the matching row of TRIPLET_CHANNELS,
+    sorted by event
+    """
+    events, ievent = np.unique(np.asarray(event), return_inverse=True)
+    channel = np.asarray(channel, dtype=np.int64)
+    # only the events with at least 3 hits can match
+    candidates = np.flatnonzero(np.bincount(ievent, minlength=len(events)) >= 3)
+    matched, triplet = match_patterns(event_masks(ievent, channel, len(events))[candidates])
+    matched = candidates[matched]
+    # hits sorted by (event, channel), to look up the hits of an event in a given channel
+    keys = ievent.astype(np.int64) * CHANNEL_KEY + channel
+    order = np.argsort(keys, kind='mergesort')
+    keys = keys[order]
+    hits = []
+    for k in (0, 1, 2):
+        target = matched * CHANNEL_KEY + TRIPLET_CHANNELS[triplet, k]
+        lo = np.searchsorted(keys, target, 'left')
+        hi = np.searchsorted(keys, target, 'right')
+        owner, pos = _expand(lo, hi - lo)
+        hits = [h[owner] for h in hits] + [pos]
+        matched, triplet = matched[owner], triplet[owner]
+    return np.column_stack([order[h] for h in hits]), triplet
+
+
+############################################# EQUATIONS
+def solve(pattern, ticks):
+    """Function returning the arrays (tzero, angle) of the meantimer equations (see meantimereq)
+    pattern = index in PATTERN_LIST of each triplet, ticks = (N, 3) int64 hit times in the order of the pattern
+    tzero is in TDC ticks
+    """
+    t1, t2, t3 = ticks[:, 0], ticks[:, 1], ticks[:, 2]
+    equation = PATTERN_EQUATION[pattern]
+    tzero = np.select([equation == EQ_ABC, equation == EQ_ABD, equation == EQ_ACD],
+                      [t1 + 2*t2 + t3, 3*t2 + 2*t1 - t3, 3*t2 + 2*t3 - t1])
+    tzero = 0.25 * (tzero - 2*TDRIFT_TICKS)
+    slope = np.select([equation == EQ_ABC, equation == EQ_ABD, equation == EQ_ACD],
+                      [t1 - t3, t3 - t2, t1 - t2])
+    angle = np.arctan(0.5 * slope * DURATION['tdc'] * VDRIFT / ZCELL) * PATTERN_SIGN[pattern]
+    return tzero, angle
+
+
+def meantimer_batch(event, sl, channel, ticks, max_spread=1.1*TDRIFT_TICKS):
+    """Function returning the MeantimerSolutions of a batch of events
+    event, sl, channel, ticks = arrays with the event id, SL, normalised channel and time (TDC ticks) of each hit
+    Triplets spanning more than max_spread ticks and solutions outside MEANTIMER_ANGLES[SL] are rejected
+    """
+    ticks = np.asarray(ticks, dtype=np.int64)
+    sl = np.asarray(sl)
+    hits, triplet = triplet_candidates(event, channel)
+    times = ticks[hits]
+    good = times.max(axis=1) - times.min(axis=1) <= max_spread
+    hits, triplet, times = hits[good], triplet[good], times[good]
+    pattern = TRIPLET_PATTERN[triplet]
+    tzero, angle = solve(pattern, times)
+    hitsl = sl[hits[:, 0]].astype(np.int64)
+    valid = (hitsl >= 0) & (hitsl < len(MEANTIMER_ANGLES))
+    hitsl = np.where(valid, hitsl, 0)
+    good = valid & (ANGLE_MIN[hitsl] < angle) & (angle < ANGLE_MAX[hitsl])
+    events, ievent = np.unique(np.asarray(event), return_inverse=True)
+    ievent = ievent[hits[good, 0]]
+    offsets = np.searchsorted(ievent, np.arange(len(events) + 1))
+    return MeantimerSolutions(events, offsets, tzero[good], angle[good], hits[good], pattern[good])
+
+
+############################################# EVENT GROUPING
+def time_groups(event, ticks, gap=1.1*TDRIFT_TICKS):
+    """Function returning the index of the group of each hit, splitting each event where the time difference of
+    consecutive hits is larger than gap ticks (as done in meantimer_results), see events.build_events
+    """
+    return build_events(ticks, event, gap).event
+
+
+############################################# PER-EVENT T0
+def event_tzeros(event, group, sl, channel, ticks, nevents):
+    """Function returning the mean t0 (TDC ticks) of the meantimer solutions of each event, NaN if none
+    event = event id of each hit in range(nevents), group = id of the groups of hits the meantimer is run on
+    (e.g. event*NSL+SL), sl, channel, ticks = as in meantimer_batch
+    """
+    mt = meantimer_batch(group, sl, channel, ticks)
+    solevent = np.asarray(event)[mt.hits[:, 0]]
+    nsolutions = np.bincount(solevent, minlength=nevents)
+    # bincount of no solutions is an integer array, even with weights
+    tzerosum = np.bincount(solevent, weights=mt.tzero, minlength=nevents).astype(np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return tzerosum / nsolutions
+
+
+############################################# WORKER POOL
+# Batches are passed to the workers through shared-memory buffers (one slot per worker) allocated once with the pool,
+# so that only the slot number and sizes are sent to the workers and only the t0 per event are sent back
+SLOT_DTYPE = np.dtype([('EVENT', np.int64), ('GROUP', np.int64), ('TICKS', np.int64), ('CHANNEL', np.int16), ('SL', np.int8)])
+SLOT_HITS  = 1 << 17          # hits per shared buffer
+
+_slots = None                 # shared buffers, as seen by a worker process
+
+
+def _slot_view(buffer):
+    return np.frombuffer(buffer, dtype=SLOT_DTYPE)
+
+
+def _init_worker(buffers):
+    global _slots
+    _slots = [_slot_view(buffer) for buffer in buffers]
+
+
+def _solve_slot(slot, size, first, nevents):
+    hits = _slots[slot][:size]
+    return first, event_tzeros(hits['EVENT'] - first, hits['GROUP'], hits['SL'], hits['CHANNEL'], hits['TICKS'], nevents)
+
+
+class MeantimerPool(object):
+    """Long-lived pool of worker processes computing the t0 per event of batches of hits (see event_tzeros)
+    processes = number of workers (default: all cores), slot_hits = size of the shared buffer of each worker
+    A batch is split on event boundaries in about one piece per worker, of at most slot_hits hits, solved in parallel
+    by the workers; events larger than a buffer are solved in this process
+    """
+
+    def __init__(self, processes=None, slot_hits=SLOT_HITS):
+        self.processes = processes if processes is not None else cpu_count()
+        self.slot_hits = slot_hits
+        self.pool = None
+        if self.processes > 1:
+            buffers = [RawArray(ctypes.c_char, SLOT_DTYPE.itemsize*slot_hits) for _ in range(self.processes)]
+            self.slots = [_slot_view(buffer) for buffer in buffers]
+            self.pool = multiprocessing.Pool(self.processes, _init_worker, (buffers,))
+
+    def event_tzeros(self, event, group, sl, channel, ticks, nevents):
+        """Function returning the mean t0 (TDC ticks) of each event, NaN if none, as event_tzeros"""
+        if self.pool is None:
+            return event_tzeros(event, group, sl, channel, ticks, nevents)
+        event = np.asarray(event)
+        order = np.argsort(event, kind='mergesort')
+        sorted_event = event[order]
+        # about one piece per worker, of at most slot_hits hits (unless a single event is larger), never splitting an
+        # event: each piece takes the events ending within target hits of its start
+        target = min(self.slot_hits, -(-len(order) // self.processes))
+        ends = np.append(np.flatnonzero(np.diff(sorted_event)) + 1, len(order))
+        bounds = [0]
+        while bounds[-1] < len(order):
+            stop = ends[np.searchsorted(ends, bounds[-1] + target, 'right') - 1]
+            if stop <= bounds[-1]:
+                stop = ends[np.searchsorted(ends, bounds[-1], 'right')]
+            bounds.append(stop)
+        tzeros = np.full(nevents, np.nan)
+        pending = []
+        free = list(range(self.processes))
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            piece = order[start:stop]
+            first, last = sorted_event[start], sorted_event[stop-1] + 1
+            if stop - start > self.slot_hits:
+                tzeros[first:last] = event_tzeros(event[piece] - first, np.asarray(group)[piece], np.asarray(sl)[piece],
+                                                  np.asarray(channel)[piece], np.asarray(ticks)[piece], last - first)
+                continue
+            if not free:
+                slot, result = pending.pop(0)
+                self._collect(result, tzeros)
+                free.append(slot)
+            slot = free.pop()
+            buf = self.slots[slot]
+            buf['EVENT'][:stop-start]   = event[piece]
+            buf['GROUP'][:stop-start]   = np.asarray(group)[piece]
+            buf['TICKS'][:stop-start]   = np.asarray(ticks)[piece]
+            buf['CHANNEL'][:stop-start] = np.asarray(channel)[piece]
+            buf['SL'][:stop-start]      = np.asarray(sl)[piece]
+            pending.append((slot, self.pool.apply_async(_solve_slot, (slot, stop - start, first, last - first))))
+        for slot, result in pending:
+            self._collect(result, tzeros)
+        return tzeros
+
+    @staticmethod
+    def _collect(result, tzeros):
+        first, values = result.get()
+        tzeros[first:first+len(values)] = values
+
+    def close(self):
+        """Stop the worker processes"""
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
@@ -0,0 +1,116 @@
+"""ANALYSIS STEPS OF THE ONLINE MONITOR
+The computations done by testplotter_new.py on each message, without the plots and the Kafka consumer, so that they
+can be run and timed on recorded data (see benchmark.py):
+
+    occupancy_rates  = occupancyPlot message: hit rate of each V7 channel, occupancy and colours of each SL
+    hit_table        = eventsDataframe message: hits with the geometry columns and the time in TDC ticks
+    event_time0      = events of the batch and their t0 (internal trigger or meantimer)
+    hit_positions    = drift time after the t0 and left/right positions of the hits in the time window
+    segments_tracks  = segments of each (event, SL) and tracks matched across the chambers
+"""
+
+import numpy as np
+from config import NSL, NVIRTEX, NCHANNELS, TICKS_PER_BX, DURATION, VDRIFT, TIME_WINDOW
+from config import GEO_NFPGA, GEO_NCHAN, GEO_SL, GEO_TDC_CHANNEL_NORM, geo_index
+from hittable import HitTable
+from events import build_events, reduce_events, broadcast
+from segments import fit_segments
+from tracks import build_tracks
+
+
+CHAN_PER_DF = 4                  # min number of channels of an (event, SL) for applying the meantimer
+OCC_PALETTE = np.array(["#%02x%02x%02x" % (level, level, level) for level in range(256)])   # grey levels, 255 = white
+HIT_TABLE_COLUMNS = ['LAYER', 'X_CHSHIFT', 'X_WIRE', 'Z_POS', 'SL', 'TDC_CHANNEL_NORM', 'TIME_TDC']
+
+
+############################################# OCCUPANCY
+def occupancy_rates(columns, read_time):
+    """Function returning (present, rates, occupancy, colors) of the counts of an occupancyPlot message
+    columns   = FPGA, TDC_CHANNEL, COUNT of the message
+    present   = (NVIRTEX, GEO_NCHAN) mask of the channels in the message, rates = their hit rate (Hz)
+    occupancy = (NSL, NCHANNELS) counts of all the (SL, channel) pairs, with one bincount
+    colors    = their colours, taken from OCC_PALETTE (white = no hits, black = most hits of the SL)
+    """
+    fpga, chan = np.asarray(columns['FPGA'], dtype=np.intp), np.asarray(columns['TDC_CHANNEL'], dtype=np.intp)
+    count = np.asarray(columns['COUNT'], dtype=np.float64)
+    ingeo = (fpga >= 0) & (fpga < GEO_NFPGA) & (chan >= 0) & (chan < GEO_NCHAN)
+    index, count = geo_index(fpga[ingeo], chan[ingeo]), count[ingeo]
+
+    # hit rate of each channel of the V7
+    invirtex = index < NVIRTEX*GEO_NCHAN
+    present = np.bincount(index[invirtex], minlength=NVIRTEX*GEO_NCHAN).reshape(NVIRTEX, GEO_NCHAN) > 0
+    rates = np.bincount(index[invirtex], weights=count[invirtex], minlength=NVIRTEX*GEO_NCHAN) / read_time
+    rates = rates.reshape(NVIRTEX, GEO_NCHAN)
+
+    # occupancy of each SL, with the (SL, normalised channel) of the geometry tables
+    sl, chan_norm = GEO_SL[index].astype(np.intp), GEO_TDC_CHANNEL_NORM[index].astype(np.intp)
+    insl = (sl >= 0) & (chan_norm >= 1)
+    occupancy = np.bincount(sl[insl]*NCHANNELS + chan_norm[insl] - 1, weights=count[insl],
+                            minlength=NSL*NCHANNELS).reshape(NSL, NCHANNELS)
+    maxcount = occupancy.max(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        value = np.where(maxcount[:, None] > 0, occupancy / maxcount[:, None], occupancy)
+    colors = OCC_PALETTE[np.where(value > 0, (255*(1 - value)).astype(np.intp), 255)]
+    return present, rates, occupancy, colors
+
+
+############################################# HITS
+def hit_table(columns):
+    """Function returning the DataFrame of the hits of an eventsDataframe message, with the geometry columns gathered
+    by HitTable from the lookup tables of config.py, TIME_TDC in exact TDC ticks and TIME0 = -1
+    """
+    hits = HitTable(columns)
+    allhits = hits.to_dataframe(hits.raw_columns + HIT_TABLE_COLUMNS)
+    allhits['TIME0'] = -1
+    return allhits
+
+
+def event_time0(allhits, pool, use_inttrig=False, chan_per_df=CHAN_PER_DF):
+    """Function returning (events, tzeros) of the hits of hit_table, and setting their TIME0 (ticks, -1 if unknown)
+    pool        = MeantimerPool computing the t0 of the events
+    use_inttrig = one event per orbit, t0 = internal trigger word (channel 139) - 10 BX, tzeros = None
+    otherwise the events are the hits close in time, across SLs and orbit boundaries, and tzeros the mean t0 of the
+    meantimer solutions of the (event, SL) with at least chan_per_df hits, NaN if none
+    """
+    ticks = allhits['TIME_TDC'].values
+    if use_inttrig:
+        events = build_events(ticks, allhits['ORBIT_CNT'].values, gap=None)
+        notrigger = np.iinfo(np.int64).max
+        timezero = reduce_events(events, np.where(allhits['TDC_CHANNEL'].values==139, ticks, notrigger), 'min')
+        allhits['TIME0'] = broadcast(events, np.where(timezero < notrigger, timezero - 10*TICKS_PER_BX, -1))
+        return events, None
+    events = build_events(ticks)
+    # the meantimer is run on all the (event, SL) groups at once
+    use = ((allhits['TDC_CHANNEL']!=139) & (allhits['SL']>=0) & ~allhits.duplicated()).values
+    slevent = events.event*NSL + allhits['SL'].values
+    use &= np.bincount(slevent[use], minlength=slevent.max()+1 if len(slevent) else 0)[slevent] >= chan_per_df
+    tzeros = pool.event_tzeros(events.event[use], slevent[use], allhits['SL'].values[use],
+                               allhits['TDC_CHANNEL_NORM'].values[use], ticks[use], events.nevents)
+    allhits['TIME0'] = broadcast(events, np.where(np.isfinite(tzeros), tzeros, -1))
+    return events, tzeros
+
+
+def hit_positions(allhits):
+    """Function returning the hits with a t0 and a drift time (TIMENS) in TIME_WINDOW, without the trigger hits,
+    with their positions left and right of the wire (X_POS_LEFT, X_POS_RIGHT)
+    """
+    idx = allhits['TIME0'] > 0
+    allhits.loc[idx, 'TIMENS'] = (allhits['TIME_TDC'] - allhits['TIME0'])*DURATION['tdc']
+    allhits = allhits.loc[(allhits['TDC_CHANNEL']!=139)]
+    allhits = allhits.loc[allhits['TIMENS'].between(TIME_WINDOW[0], TIME_WINDOW[1], inclusive=False)]
+    allhits['X_POS_LEFT']  = allhits['X_WIRE'] - np.maximum(allhits['TIMENS'], 0)*VDRIFT
+    allhits['X_POS_RIGHT'] = allhits['X_WIRE'] + np.maximum(allhits['TIMENS'], 0)*VDRIFT
+    return allhits
+
+
+def segments_tracks(allhits, events):
+    """Function returning (segments, tracks) of the hits of hit_positions: best segment of each (event, SL) (id
+    event*NSL+SL) and tracks matched across the chambers
+    """
+    chamberhits = allhits.loc[allhits['SL']>=0]
+    slevent = events.event[chamberhits.index.values]*NSL + chamberhits['SL'].values
+    seg = fit_segments(slevent, chamberhits['X_POS_LEFT'].values, chamberhits['X_POS_RIGHT'].values,
+                       chamberhits['Z_POS'].values)
+    tracks = build_tracks(seg.events % NSL, chamberhits.groupby(slevent)['TIME0'].first().values,
+                          seg.slope, seg.intercept)
+    return seg, tracks
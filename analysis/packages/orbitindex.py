@@ -0,0 +1,153 @@
+"""ORBIT INDEX OF THE DATA FILES
+Sidecar index (<file>.idx) mapping blocks of INDEX_BLOCK consecutive hits of a .dat or .txt file to their
+(ORBIT_MIN, ORBIT_MAX) range and byte span in the file, so that an orbit range is read by seeking straight to the
+overlapping blocks instead of parsing the whole file.
+The index is built lazily on first access and rebuilt when the size of the data file changes.
+Orbit counters are not monotonic over a whole file (resets, stale buffers), hence the blocks are split in runs of
+non-decreasing ORBIT_MIN, each searched with a binary search
+"""
+
+import io
+import os
+import numpy as np
+import pandas as pd
+from config import DURATION
+from unpacker import HIT_COLUMNS, WORD_DTYPE, map_words, unpack, to_dataframe, csv_to_hits, read_csv
+
+
+INDEX_BLOCK  = 4096       # hits per block of the index
+INDEX_SUFFIX = '.idx'
+INDEX_DTYPE  = np.dtype([('ORBIT_MIN', '<u4'), ('ORBIT_MAX', '<u4'), ('START', '<u8'), ('STOP', '<u8'), ('ROW', '<u8')])
+
+
+############################################# INDEX CREATION
+def build_index(file_path, block=INDEX_BLOCK):
+    """Function returning the array of blocks (INDEX_DTYPE) of a .dat or .txt file
+    START/STOP = byte span of the block in the file, ROW = index of the first hit (line) of the block
+    """
+    if file_path.endswith('.dat'):
+        words = map_words(file_path)
+        starts = np.arange(0, len(words), block)
+        blocks = np.zeros(len(starts), dtype=INDEX_DTYPE)
+        for i, start in enumerate(starts):
+            orbits = unpack(words[start:start+block])['ORBIT_CNT']
+            blocks[i] = (orbits.min() if len(orbits) else 0, orbits.max() if len(orbits) else 0,
+                         start*WORD_DTYPE.itemsize, min(start+block, len(words))*WORD_DTYPE.itemsize, start)
+        return blocks
+    # unpacked file: byte offsets of the lines from the positions of the newlines
+    with open(file_path, 'rb') as f:
+        content = f.read()
+    newlines = np.flatnonzero(np.frombuffer(content, dtype=np.uint8) == ord('\n'))
+    linestarts = newlines + 1
+    linestarts = linestarts[linestarts < len(content)]        # start of each line after the header
+    # the orbit is read by position, in one pass: the hit lines have 6 fields, the trigger lines 7
+    orbits = pd.read_csv(io.BytesIO(content), header=None, skiprows=1, usecols=[HIT_COLUMNS.index('ORBIT_CNT')],
+                         low_memory=False)
+    orbits = orbits.iloc[:, 0].values.astype(np.float64)
+    blocks = np.zeros(len(range(0, len(linestarts), block)), dtype=INDEX_DTYPE)
+    for i, start in enumerate(range(0, len(linestarts), block)):
+        stop = min(start+block, len(linestarts))
+        valid = orbits[start:stop][~np.isnan(orbits[start:stop])]
+        blocks[i] = (valid.min() if len(valid) else 0, valid.max() if len(valid) else 0,
+                     linestarts[start], linestarts[stop] if stop < len(linestarts) else len(content), start)
+    return blocks
+
+
+def load_index(file_path, write=True):
+    """Function returning the blocks of the index of a data file, building (and writing) it if missing or stale"""
+    size = os.path.getsize(file_path)
+    try:
+        with open(file_path + INDEX_SUFFIX, 'rb') as f:
+            stored = np.load(f)
+            if int(stored['size']) == size:
+                return stored['blocks']
+    except (IOError, OSError, KeyError, ValueError):
+        pass
+    blocks = build_index(file_path)
+    if write:
+        try:
+            with open(file_path + INDEX_SUFFIX, 'wb') as f:
+                np.savez(f, blocks=blocks, size=size)
+        except (IOError, OSError):
+            pass   # read-only data folder: keep the index in memory only
+    return blocks
+
+
+############################################# BLOCK SELECTION
+def select_blocks(blocks, orbit_range):
+    """Function returning the indices of the blocks overlapping orbit_range = (first, last), both included"""
+    first, last = orbit_range
+    selected = []
+    # runs of blocks with non-decreasing ORBIT_MIN
+    runs = np.split(np.arange(len(blocks)), np.flatnonzero(np.diff(blocks['ORBIT_MIN'].astype(np.int64)) < 0) + 1)
+    for run in runs:
+        if len(run) == 0:
+            continue
+        omin = blocks['ORBIT_MIN'][run]
+        omax = np.maximum.accumulate(blocks['ORBIT_MAX'][run])
+        lo = np.searchsorted(omax, first, 'left')
+        hi = np.searchsorted(omin, last, 'right')
+        candidates = run[lo:hi]
+        selected.append(candidates[blocks['ORBIT_MAX'][candidates] >= first])
+    return np.concatenate(selected) if selected else np.zeros(0, dtype=np.int64)
+
+
+def block_spans(blocks, selected):
+    """Function returning the list of (START, STOP, ROW) spans merging adjacent selected blocks"""
+    spans = []
+    for i in selected:
+        b = blocks[i]
+        if spans and spans[-1][1] == b['START']:
+            spans[-1][1] = int(b['STOP'])
+        else:
+            spans.append([int(b['START']), int(b['STOP']), int(b['ROW'])])
+    return spans
+
+
+############################################# READING
+def read_span(file_path, start, stop):
+    """Function returning the DataFrame of the hits in the byte span [start, stop) of a .dat or .txt file"""
+    if file_path.endswith('.dat'):
+        size = WORD_DTYPE.itemsize
+        return to_dataframe(unpack(map_words(file_path, start // size, (stop - start) // size)))
+    with open(file_path, 'rb') as f:
+        header = f.readline()
+        f.seek(start)
+        content = f.read(stop - start)
+    return to_dataframe(csv_to_hits(read_csv(io.BytesIO(header + content))))
+
+
+def read_orbit_range(file_path, orbit_range, skip=0):
+    """Function returning the DataFrame of the hits of a file with orbit in orbit_range = (first, last)
+    skip = number of hits to skip at the beginning of the file
+    """
+    blocks = load_index(file_path)
+    spans = block_spans(blocks, select_blocks(blocks, orbit_range))
+    dfs = []
+    for start, stop, row in spans:
+        if file_path.endswith('.dat') and row < skip:
+            start = max(start, skip * WORD_DTYPE.itemsize)
+            row = max(row, skip)
+        if start >= stop:
+            continue
+        df = read_span(file_path, start, stop)
+        if row < skip:
+            df = df.iloc[skip - row:]
+        dfs.append(df[df['ORBIT_CNT'].between(orbit_range[0], orbit_range[1])])
+    if not dfs:
+        return to_dataframe(unpack(np.zeros(0, dtype=WORD_DTYPE)))
+    return pd.concat(dfs, ignore_index=True)[HIT_COLUMNS]
+
+
+def file_orbit_range(file_path):
+    """Function returning the (min, max) orbit of a data file from its index"""
+    blocks = load_index(file_path)
+    if len(blocks) == 0:
+        return None
+    return int(blocks['ORBIT_MIN'].min()), int(blocks['ORBIT_MAX'].max())
+
+
+def time_to_orbit_range(first_orbit, window):
+    """Function returning the orbit range corresponding to a time window = (start, stop) in s after first_orbit"""
+    orbit_s = DURATION['orbit'] * 1e-9
+    return (int(first_orbit + np.floor(window[0] / orbit_s)), int(first_orbit + np.ceil(window[1] / orbit_s)))
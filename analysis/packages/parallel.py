@@ -0,0 +1,45 @@
+"""PROCESS POOLS
+Helpers to spread independent jobs (e.g. the decoding of the files of a run) over a pool of worker processes.
+Results are returned in the order of submission and only a bounded number of jobs is in flight at any time, so that
+the memory used does not depend on how much faster the workers are than the consumer of the results
+"""
+
+import multiprocessing
+from collections import deque
+
+
+def cpu_count():
+    """Function returning the number of cores available, 1 if unknown"""
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def imap_ordered(func, items, processes=None, inflight=None):
+    """Generator of func(item) for each item, computed in a pool of worker processes and yielded in order
+    func     = function at module level (picklable), item = tuple of its arguments
+    inflight = max number of submitted jobs not yet consumed (default: twice the number of processes)
+    With processes <= 1 the jobs are run one by one in this process
+    """
+    if processes is None:
+        processes = cpu_count()
+    if processes <= 1:
+        for item in items:
+            yield func(*item)
+        return
+    if inflight is None:
+        inflight = 2 * processes
+    pool = multiprocessing.Pool(processes)
+    try:
+        pending = deque()
+        for item in items:
+            pending.append(pool.apply_async(func, item))
+            if len(pending) >= inflight:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
@@ -94,3 +94,39 @@ for name, patterns in PATTERNS.items():
         PATTERN_NAMES[pattern] = name
 
 
+
+
+############################################# PATTERN BITMASKS
+# The cells fired in an event of a SL (NCHANNELS <= 64) fit in a uint64 (bit = TDC_CHANNEL_NORM - 1): a triplet of
+# channels matches an event when all of its bits are set in the mask of the event
+TRIPLETS      = sorted(PATTERN_NAMES.keys())
+TRIPLET_MASKS = np.array([sum(1 << (ch - 1) for ch in triplet) for triplet in TRIPLETS], dtype=np.uint64)
+
+
+def channel_bits(channel):
+    """Function returning the uint64 bit of each normalised channel (0 for channels outside 1..NCHANNELS)"""
+    channel = np.asarray(channel, dtype=np.int64)
+    inrange = (channel >= 1) & (channel <= NCHANNELS)
+    return np.where(inrange, np.left_shift(np.uint64(1), np.where(inrange, channel - 1, 0).astype(np.uint64)), np.uint64(0))
+
+
+def event_masks(ievent, channel, nevents):
+    """Function returning the uint64 mask of the fired channels of each event of a batch
+    ievent = index of the event of each hit in range(nevents), channel = normalised channel of each hit
+    """
+    ievent = np.asarray(ievent)
+    order = np.argsort(ievent, kind='mergesort')
+    masks = np.zeros(nevents, dtype=np.uint64)
+    if len(order):
+        starts = np.flatnonzero(np.concatenate([[True], ievent[order][1:] != ievent[order][:-1]]))
+        masks[ievent[order][starts]] = np.bitwise_or.reduceat(channel_bits(channel)[order], starts)
+    return masks
+
+
+def match_patterns(masks):
+    """Function returning (ievent, itriplet) of every triplet of TRIPLETS fully contained in each mask of a batch,
+    sorted by event
+    """
+    masks = np.asarray(masks, dtype=np.uint64)
+    matched = (masks[:, None] & TRIPLET_MASKS[None, :]) == TRIPLET_MASKS[None, :]
+    return np.nonzero(matched)
@@ -1,9 +1,11 @@
 #!/usr/bin/env python
-from bokeh.models import ColumnDataSource
+from bokeh.models import ColumnDataSource, LinearColorMapper
 from bokeh.plotting import figure
 from bokeh.transform import cumsum
 from bokeh.models.widgets import Panel, Tabs
 from bokeh.layouts import row, column, gridplot
+from bokeh.palettes import Greys256
+import numpy as np
 from config import *
 
 ### PLOTS ###
@@ -103,11 +105,17 @@ for theSL in range(NSL):
 t_tdcc  = Panel(child=gridplot([[p_tdcc[0],p_tdcc[1]],[p_tdcc[2],p_tdcc[3]]]), title='Active channels')
 
 # posg
+# hit positions binned on a grid aligned with the cells (staggered by XCELL/2, one row per layer), drawn as an image
+# whose size does not depend on the number of hits
+POSG_XBINS  = 8*(NCHANNELS//4+1) + 4
+POSG_XRANGE = (-XCELL/2, XCELL*(NCHANNELS/4+1))
+POSG_ZBINS  = 4
+POSG_ZRANGE = (0, 4*ZCELL)
 posg_ds = {}
 posg_last_ds = {}
 p_posg = {}
 for theSL in range(NSL):
-  posg_ds[theSL] = ColumnDataSource(dict(xpos_l=[],xpos_r=[],zpos=[]))
+  posg_ds[theSL] = ColumnDataSource(dict(image=[np.zeros((POSG_ZBINS,POSG_XBINS))]))
   posg_last_ds[theSL] = ColumnDataSource(dict(xpos_l_last=[],xpos_r_last=[],zpos_last=[]))
   p_posg[theSL] = figure(plot_width=1800,
                plot_height=120,
@@ -117,22 +125,19 @@ for theSL in range(NSL):
                y_axis_label="y (mm)",
                x_axis_label="x (mm)",
 	       toolbar_location="above")
+  p_posg[theSL].image(image='image',
+            x=POSG_XRANGE[0],
+            y=POSG_ZRANGE[0],
+            dw=POSG_XRANGE[1]-POSG_XRANGE[0],
+            dh=POSG_ZRANGE[1]-POSG_ZRANGE[0],
+            color_mapper=LinearColorMapper(palette=Greys256[::-1]),
+            source=posg_ds[theSL])
   p_posg[theSL].quad(top=grid_t,
            bottom=grid_b,
            left=grid_l,
            right=grid_r, 
-           fill_color='white',
+           fill_color=None,
            line_color='black')
-  p_posg[theSL].scatter(x='xpos_r',
-              y='zpos',
-              marker='square',
-              size=2,
-              source=posg_ds[theSL])
-  p_posg[theSL].scatter(x='xpos_l',
-              y='zpos',
-              marker='square',
-              size=2,
-              source=posg_ds[theSL])
   p_posg[theSL].scatter(x='xpos_r_last',
               y='zpos_last',
               marker='square',
@@ -148,6 +153,30 @@ for theSL in range(NSL):
 t_posg  = Panel(child=column(p_posg[0],p_posg[1],p_posg[2],p_posg[3]), title='Hits in geometry')
 
 
+### INCREMENTAL UPDATES ###
+# the data sources are updated only with what changed (the counts of the histograms, not their edges), so that the
+# traffic of each update does not grow with the run; the columns replaced are NumPy arrays, sent by bokeh as binary
+# buffers instead of JSON lists
+
+def binary_array(column):
+  # NumPy array with a dtype that bokeh can serialize (not float16, e.g. Z_POS) and send as a binary buffer (not int64,
+  # e.g. the counts of the histograms)
+  column = np.asarray(column)
+  if column.dtype == np.float16:
+    return column.astype(np.float32)
+  if column.dtype == np.int64:
+    return column.astype(np.float64)
+  return column
+
+def patch_hist(source, counts_name, counts, **edges):
+  # update a histogram with fixed binning: the edges are sent the first time (or when the binning changes), then only
+  # the counts column is replaced, as a binary buffer
+  update = {counts_name: binary_array(counts)}
+  if len(source.data[counts_name]) != len(counts):
+    update.update((name, binary_array(edge)) for name, edge in edges.items())
+  source.data.update(**update)
+
+
 ### WEBPAGE TABS ###
 # tabs = Tabs(tabs=[t_chan,t_occ,t_tmb,t_posg])
 tabs = Tabs(tabs=[t_chan,t_occ,t_tmb,t_posx,t_tdcc,t_posg])
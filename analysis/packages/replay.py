@@ -0,0 +1,104 @@
+"""RUN REPLAY
+The hits of recorded runs (.dat, .txt files or hit stores, read with ingest.py) are cut into batches of window seconds
+of run time, measured from ORBIT_CNT, and each batch is published as the two messages produced online: the hits on
+eventsDataframe and the counts per (FPGA, TDC_CHANNEL) on occupancyPlot.
+The batches are sent at speed times the real rate (batch k at k*window/speed s after the start, speed = 0 for as fast
+as possible), to a KafkaProducer or to the LocalProducer of transport.py
+"""
+
+import json
+import time
+import numpy as np
+import pandas as pd
+from config import DURATION, GEO_NFPGA, GEO_NCHAN, geo_index
+from kafkapayload import encode, KIND_HITS, KIND_OCCUPANCY, OCCUPANCY_DTYPE
+from unpacker import HIT_COLUMNS
+
+
+TOPIC_HITS      = 'eventsDataframe'
+TOPIC_OCCUPANCY = 'occupancyPlot'
+FORMATS = ('binary', 'json')
+# columns of the JSON eventsDataframe messages with a different name (see hittable.ALIASES)
+JSON_ALIASES = {'TDC_MEAS': 'TDC_MEANS'}
+ORBIT_S = DURATION['orbit'] * 1e-9
+
+
+def iter_batches(chunks, window):
+    """Generator of (start, stop, hits) of the batches of window s of run time, start and stop in s from the first orbit
+    chunks = DataFrames of hits not splitting orbits (e.g. ingest.iter_orbit_chunks), in time order
+    The hits of the last batch of a chunk, which may continue in the next chunk, are held back
+    """
+    first = None
+    pending, pending_number = None, None
+    for df in chunks:
+        if len(df) == 0:
+            continue
+        if pending is not None:
+            df = pd.concat([pending, df], ignore_index=True)
+        if first is None:
+            first = int(df['ORBIT_CNT'].iloc[0])
+        batch = np.floor((df['ORBIT_CNT'].values.astype(np.float64) - first) * ORBIT_S / window).astype(np.int64)
+        pending_number = batch.max()
+        is_open = batch == pending_number
+        pending = df[is_open].reset_index(drop=True)
+        for number in np.unique(batch[~is_open]):
+            yield number*window, (number + 1)*window, df[batch == number].reset_index(drop=True)
+    if pending is not None:
+        yield pending_number*window, (pending_number + 1)*window, pending
+
+
+def occupancy_counts(hits):
+    """Function returning the OCCUPANCY_DTYPE array of the number of hits of each (FPGA, TDC_CHANNEL) present"""
+    counts = np.bincount(geo_index(hits['FPGA'], hits['TDC_CHANNEL']), minlength=GEO_NFPGA*GEO_NCHAN)
+    present = np.flatnonzero(counts)
+    occupancy = np.zeros(len(present), dtype=OCCUPANCY_DTYPE)
+    occupancy['FPGA'], occupancy['TDC_CHANNEL'] = present // GEO_NCHAN, present % GEO_NCHAN
+    occupancy['COUNT'] = counts[present]
+    return occupancy
+
+
+def batch_messages(hits, run=0, window=(0., 0.), fmt='binary'):
+    """Function returning the [(topic, bytes)] messages of a batch of hits
+    fmt = 'binary' (kafkapayload.py) or 'json' (dict of the columns, as the messages read by testplotter.py)
+    """
+    occupancy = occupancy_counts(hits)
+    if fmt == 'binary':
+        return [(TOPIC_OCCUPANCY, encode(occupancy, KIND_OCCUPANCY, run, window)),
+                (TOPIC_HITS, encode(hits, KIND_HITS, run, window))]
+    if fmt == 'json':
+        counts = dict((name, occupancy[name].tolist()) for name in OCCUPANCY_DTYPE.names)
+        columns = dict((JSON_ALIASES.get(name, name), np.asarray(hits[name]).tolist()) for name in HIT_COLUMNS)
+        return [(TOPIC_OCCUPANCY, json.dumps(counts).encode('ascii')),
+                (TOPIC_HITS, json.dumps(columns).encode('ascii'))]
+    raise ValueError('batch_messages: format must be one of %s' % ', '.join(FORMATS))
+
+
+def replay(batches, producer, run=0, speed=1., fmt='binary', verbose=False):
+    """Publish the batches of iter_batches on producer, paced at speed times the real rate (0 = no pacing)
+    Returns the dict of the number of batches, messages, hits, bytes sent, elapsed time (s) and max delay (s) of a
+    batch behind its schedule
+    """
+    stats = dict(batches=0, messages=0, hits=0, bytes=0, elapsed=0., delay=0.)
+    begin = time.time()
+    first = None
+    for start, stop, hits in batches:
+        if first is None:
+            first = start
+        if speed > 0:
+            # a batch is complete at the end of its window
+            due = begin + (stop - first) / speed
+            wait = due - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            stats['delay'] = max(stats['delay'], -wait)
+        for topic, value in batch_messages(hits, run, (start, stop), fmt):
+            producer.send(topic, value)
+            stats['messages'] += 1
+            stats['bytes'] += len(value)
+        stats['batches'] += 1
+        stats['hits'] += len(hits)
+        if verbose:
+            print('batch %.1f-%.1f s: %d hits' % (start, stop, len(hits)))
+    producer.flush()
+    stats['elapsed'] = time.time() - begin
+    return stats
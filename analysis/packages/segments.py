@@ -0,0 +1,78 @@
+"""LINEAR SEGMENT FIT WITH LEFT/RIGHT AMBIGUITY
+Each hit has two possible positions, left and right of the wire. For every event of a batch with 3 to MAX_HITS hits,
+all the 2^n laterality hypotheses are fitted at once with the closed-form least squares of x = slope*z + intercept,
+and the hypothesis with the lowest chi2 is retained.
+Events with the same number of hits are processed together, in blocks of BLOCK_EVENTS events to bound the memory
+"""
+
+from collections import namedtuple
+import numpy as np
+
+
+MIN_HITS     = 3
+MAX_HITS     = 8
+BLOCK_EVENTS = 4096
+SIGMA_X      = 1.      # resolution on the hit position (mm) used in the chi2
+
+
+class Segments(namedtuple('Segments', ['events', 'slope', 'intercept', 'chi2', 'nhits', 'laterality'])):
+    """Best segment of each event (NaN for the events with too few or too many hits)
+    events     = sorted unique event ids
+    slope, intercept = parameters of x = slope*z + intercept
+    chi2       = sum of the squared residuals / SIGMA_X^2 of the best hypothesis
+    laterality = bitmask of the hits taken on the right of the wire, bit i = i-th hit of the event in input order
+    """
+    __slots__ = ()
+
+
+def laterality_bits(nhits):
+    """Function returning the (2^nhits, nhits) boolean matrix of all the left (False) / right (True) hypotheses"""
+    return (np.arange(1 << nhits)[:, None] >> np.arange(nhits)[None, :]) & 1 == 1
+
+
+def fit_hypotheses(x_left, x_right, z, sigma=SIGMA_X):
+    """Function returning (slope, intercept, chi2) of all the laterality hypotheses of a block of events
+    x_left, x_right, z = (E, n) arrays of the hits of E events with n hits each
+    Returns (E, 2^n) arrays, chi2 = inf for degenerate hypotheses (all hits at the same z)
+    """
+    nevents, n = z.shape
+    right = laterality_bits(n)
+    x = np.where(right[None, :, :], x_right[:, None, :], x_left[:, None, :])       # (E, H, n)
+    zz = z[:, None, :]
+    sz, szz = z.sum(axis=1)[:, None], (z*z).sum(axis=1)[:, None]
+    sx, szx = x.sum(axis=2), (x*zz).sum(axis=2)
+    det = n*szz - sz*sz
+    with np.errstate(invalid='ignore', divide='ignore'):
+        slope = (n*szx - sz*sx) / det
+        intercept = (sx - slope*sz) / n
+        chi2 = (((x - slope[:, :, None]*zz - intercept[:, :, None]) / sigma)**2).sum(axis=2)
+    degenerate = ~np.isfinite(chi2) | (det == 0)
+    slope[degenerate], intercept[degenerate], chi2[degenerate] = np.nan, np.nan, np.inf
+    return slope, intercept, chi2
+
+
+def fit_segments(event, x_left, x_right, z, min_hits=MIN_HITS, max_hits=MAX_HITS, sigma=SIGMA_X):
+    """Function returning the best Segments of a batch of events
+    event = event id of each hit, x_left, x_right = positions of each hit left/right of the wire, z = its z position
+    """
+    events, ievent = np.unique(np.asarray(event), return_inverse=True)
+    x_left, x_right, z = [np.asarray(a, dtype=np.float64) for a in (x_left, x_right, z)]
+    nevents = len(events)
+    slope, intercept, chi2 = np.full(nevents, np.nan), np.full(nevents, np.nan), np.full(nevents, np.nan)
+    laterality = np.zeros(nevents, dtype=np.int64)
+    nhits = np.bincount(ievent, minlength=nevents)
+    # hits sorted by event (stable, keeping the input order within an event)
+    order = np.argsort(ievent, kind='mergesort')
+    first = np.concatenate([[0], np.cumsum(nhits)[:-1]]).astype(np.int64)
+    for n in range(min_hits, max_hits + 1):
+        selected = np.flatnonzero(nhits == n)
+        for start in range(0, len(selected), BLOCK_EVENTS):
+            block = selected[start:start+BLOCK_EVENTS]
+            rows = order[first[block][:, None] + np.arange(n)[None, :]]              # (E, n) hit indices
+            s, i, c = fit_hypotheses(x_left[rows], x_right[rows], z[rows], sigma)
+            best = np.argmin(c, axis=1)
+            picked = np.arange(len(block))
+            slope[block], intercept[block], chi2[block] = s[picked, best], i[picked, best], c[picked, best]
+            laterality[block] = best
+    chi2[np.isinf(chi2)] = np.nan
+    return Segments(events, slope, intercept, chi2, nhits, laterality)
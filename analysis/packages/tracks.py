@@ -0,0 +1,79 @@
+"""CROSS-CHAMBER TRACKS
+The segments fitted in each SL (see segments.py) are matched to the segments of the SL of the other chamber crossed
+by the same muon (TRACK_SL_PAIRS of config.py). The segments of the upper SL are sorted by time once and, for each
+segment of the lower SL, the closest one in time is found with a binary search (searchsorted) and kept if within
+TRACK_TIME_WINDOW, so that the cost grows as n*log(n) with the number of segments.
+The global track is the line through the centres of the two segments: the differences between its slope and those of
+the two segments monitor the relative alignment of the chambers
+"""
+
+from collections import namedtuple
+import numpy as np
+from config import ZCELL, SL_ZSHIFT, TRACK_SL_PAIRS, TRACK_TIME_WINDOW
+
+
+class Tracks(namedtuple('Tracks', ['lower', 'upper', 'sl', 'time', 'slope', 'intercept',
+                                   'dslope_lower', 'dslope_upper', 'dtime'])):
+    """Global tracks made of two matched segments
+    lower, upper = indices of the segments of the lower and upper SL in the input arrays
+    sl         = SL of the lower segment
+    time       = mean time of the two segments
+    slope, intercept = parameters of x = slope*z + intercept in the global frame (SL_ZSHIFT of config.py)
+    dslope_lower, dslope_upper = slope of each segment minus the slope of the track
+    dtime      = time of the upper segment minus the time of the lower one
+    """
+    __slots__ = ()
+
+
+def segment_centres(sl, slope, intercept):
+    """Function returning the global (x, z) of the centre of segments fitted in the local frame of their SL"""
+    zlocal = 2*ZCELL
+    x = np.asarray(intercept) + np.asarray(slope)*zlocal
+    return x, np.asarray(SL_ZSHIFT)[np.asarray(sl)] + zlocal
+
+
+def match_closest(time_a, time_b, window=TRACK_TIME_WINDOW):
+    """Function returning the indices (ia, ib) of the pairs of a and b matched in time
+    each a is paired with the closest b in time (the earlier one on ties), if within window; a b can be paired
+    with more than one a
+    """
+    time_a, time_b = np.asarray(time_a), np.asarray(time_b)
+    if len(time_a) == 0 or len(time_b) == 0:
+        return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+    order = np.argsort(time_b, kind='mergesort')
+    sorted_b = time_b[order]
+    right = np.searchsorted(sorted_b, time_a)
+    left = np.maximum(right - 1, 0)
+    right = np.minimum(right, len(sorted_b) - 1)
+    dleft, dright = np.abs(time_a - sorted_b[left]), np.abs(sorted_b[right] - time_a)
+    best = np.where(dright < dleft, right, left)
+    with np.errstate(invalid='ignore'):
+        ia = np.flatnonzero(np.minimum(dleft, dright) <= window)
+    return ia, order[best[ia]]
+
+
+def build_tracks(sl, time, slope, intercept, pairs=TRACK_SL_PAIRS, window=TRACK_TIME_WINDOW, max_dslope=None):
+    """Function returning the Tracks matching the segments of the SL pairs
+    sl, time, slope, intercept = SL, time (e.g. t0 in TDC ticks) and local parameters of each segment, NaN if not fitted
+    max_dslope = max difference of the slopes of the two segments, None for no cut
+    """
+    sl, time = np.asarray(sl), np.asarray(time, dtype=np.float64)
+    slope, intercept = np.asarray(slope, dtype=np.float64), np.asarray(intercept, dtype=np.float64)
+    valid = np.isfinite(slope) & np.isfinite(intercept) & np.isfinite(time)
+    lower, upper = [np.zeros(0, dtype=np.intp)], [np.zeros(0, dtype=np.intp)]
+    for lower_sl, upper_sl in pairs:
+        candidates_lower = np.flatnonzero(valid & (sl == lower_sl))
+        candidates_upper = np.flatnonzero(valid & (sl == upper_sl))
+        ia, ib = match_closest(time[candidates_lower], time[candidates_upper], window)
+        lower.append(candidates_lower[ia])
+        upper.append(candidates_upper[ib])
+    lower, upper = np.concatenate(lower), np.concatenate(upper)
+    if max_dslope is not None:
+        keep = np.abs(slope[lower] - slope[upper]) <= max_dslope
+        lower, upper = lower[keep], upper[keep]
+    x_lower, z_lower = segment_centres(sl[lower].astype(np.intp), slope[lower], intercept[lower])
+    x_upper, z_upper = segment_centres(sl[upper].astype(np.intp), slope[upper], intercept[upper])
+    track_slope = (x_upper - x_lower) / (z_upper - z_lower)
+    track_intercept = x_lower - track_slope*z_lower
+    return Tracks(lower, upper, sl[lower], 0.5*(time[lower] + time[upper]), track_slope, track_intercept,
+                  slope[lower] - track_slope, slope[upper] - track_slope, time[upper] - time[lower])
@@ -0,0 +1,135 @@
+"""IN-PROCESS KAFKA STAND-IN
+LocalBroker keeps the messages of each topic in memory (one partition per topic), and LocalProducer / LocalConsumer
+implement the part of the KafkaProducer / KafkaConsumer interface used by the replay and by the monitor (send, flush,
+subscribe, poll, assignment, highwater, position), so that the online path can be run and benchmarked in a single
+process without brokers. Only the last retention messages of each topic are kept, as a broker with a retention
+"""
+
+import threading
+import time
+from collections import namedtuple, deque
+
+
+class TopicPartition(namedtuple('TopicPartition', ['topic', 'partition'])):
+    """Partition of a topic, as kafka.TopicPartition"""
+    __slots__ = ()
+
+
+class Record(namedtuple('Record', ['topic', 'partition', 'offset', 'timestamp', 'value'])):
+    """Message returned by LocalConsumer.poll, with the fields of kafka.ConsumerRecord used by the monitor
+    timestamp = time of the send in ms
+    """
+    __slots__ = ()
+
+
+class LocalBroker(object):
+    """In-memory log of the messages of each topic
+    retention = max number of messages kept per topic, None to keep all of them
+    """
+
+    def __init__(self, retention=1000):
+        self.retention = retention
+        self.logs = {}
+        self.first = {}
+        self.condition = threading.Condition()
+
+    def append(self, topic, value):
+        """Append a message to a topic, returns its offset"""
+        with self.condition:
+            log = self.logs.setdefault(topic, deque())
+            offset = self.first.setdefault(topic, 0) + len(log)
+            log.append(Record(topic, 0, offset, int(time.time()*1000), value))
+            if self.retention is not None and len(log) > self.retention:
+                log.popleft()
+                self.first[topic] += 1
+            self.condition.notify_all()
+        return offset
+
+    def highwater(self, topic):
+        """Function returning the offset of the next message of a topic"""
+        with self.condition:
+            return self.first.get(topic, 0) + len(self.logs.get(topic, ()))
+
+    def fetch(self, topic, offset, max_records):
+        """Function returning the messages of a topic from offset (or from the oldest one kept), at most max_records"""
+        with self.condition:
+            log = self.logs.get(topic, ())
+            start = max(offset - self.first.get(topic, 0), 0)
+            return [log[i] for i in range(start, min(start + max_records, len(log)))]
+
+    def wait(self, timeout):
+        """Wait for a new message on any topic, at most timeout (s)"""
+        with self.condition:
+            self.condition.wait(timeout)
+
+
+class LocalProducer(object):
+    """Producer publishing on a LocalBroker, with the interface of KafkaProducer used by the replay"""
+
+    def __init__(self, broker, value_serializer=None):
+        self.broker = broker
+        self.value_serializer = value_serializer
+
+    def send(self, topic, value):
+        if self.value_serializer is not None:
+            value = self.value_serializer(value)
+        return self.broker.append(topic, value)
+
+    def flush(self, timeout=None):
+        pass
+
+    def close(self, timeout=None):
+        pass
+
+
+class LocalConsumer(object):
+    """Consumer reading from a LocalBroker, with the interface of KafkaConsumer used by the monitor
+    auto_offset_reset = 'latest' to read only the messages sent after subscribe, 'earliest' to read all those kept
+    """
+
+    def __init__(self, broker, auto_offset_reset='latest', value_deserializer=None):
+        if auto_offset_reset not in ('latest', 'earliest'):
+            raise ValueError("LocalConsumer: auto_offset_reset must be 'latest' or 'earliest'")
+        self.broker = broker
+        self.auto_offset_reset = auto_offset_reset
+        self.value_deserializer = value_deserializer
+        self.positions = {}
+
+    def subscribe(self, topics):
+        latest = self.auto_offset_reset == 'latest'
+        self.positions = dict((TopicPartition(topic, 0), self.broker.highwater(topic) if latest else 0)
+                              for topic in topics)
+
+    def subscription(self):
+        return set(partition.topic for partition in self.positions)
+
+    def assignment(self):
+        return set(self.positions)
+
+    def highwater(self, partition):
+        return self.broker.highwater(partition.topic)
+
+    def position(self, partition):
+        return self.positions[partition]
+
+    def poll(self, timeout_ms=0, max_records=500):
+        """Function returning the dict {TopicPartition: [Record]} of the next messages, waiting at most timeout_ms"""
+        deadline = time.time() + timeout_ms/1000.
+        while True:
+            records = {}
+            left = max_records
+            for partition in sorted(self.positions):
+                fetched = self.broker.fetch(partition.topic, self.positions[partition], left)
+                if fetched:
+                    self.positions[partition] = fetched[-1].offset + 1
+                    if self.value_deserializer is not None:
+                        fetched = [record._replace(value=self.value_deserializer(record.value)) for record in fetched]
+                    records[partition] = fetched
+                    left -= len(fetched)
+            if records or time.time() >= deadline:
+                return records
+            # short waits, a message appended between the fetch and the wait is not missed for long
+            self.broker.wait(min(max(deadline - time.time(), 0), 0.1))
+
+    def close(self):
+        pass
@@ -0,0 +1,185 @@
+"""UNPACKING OF THE RAW DMA WORDS
+Vectorised counterpart of the on-the-fly unpacking done in DAQ/run_DMA.c.
+The raw data_NNNNNN.dat files are memory-mapped as 64-bit little-endian words and every field is extracted
+with NumPy shifts and masks, block by block, into a compact structured array with the same columns as the
+unpacked data_NNNNNN.txt files.
+Hit words (HEAD <= 2) and firmware trigger-primitive words (HEAD == 3) are unpacked into separate tables
+"""
+
+import os
+import numpy as np
+import pandas as pd
+
+
+############################################# HIT WORD LAYOUT
+# (name, first bit, mask, dtype) --- same as hfirst*/hmask* in DAQ/run_DMA.c
+HIT_FIELDS = [
+    ('HEAD',        62, 0x3,        np.uint8),
+    ('FPGA',        58, 0xF,        np.uint8),
+    ('TDC_CHANNEL', 49, 0x1FF,      np.uint16),
+    ('ORBIT_CNT',   17, 0xFFFFFFFF, np.uint32),
+    ('BX_COUNTER',   5, 0xFFF,      np.uint16),
+    ('TDC_MEAS',     0, 0x1F,       np.int8),   # signed: the -1 correction can bring 0 to -1
+]
+HIT_DTYPE = np.dtype([(name, dtype) for name, _, _, dtype in HIT_FIELDS])
+HIT_COLUMNS = list(HIT_DTYPE.names)
+
+############################################# TRIGGER WORD LAYOUT
+# (name, first bit, mask, dtype) --- same as tfirst*/tmask* in DAQ/run_DMA.c, in the order of the unpacked files
+TRIGGER_FIELDS = [
+    ('HEAD',    62, 0x3,        np.uint8),
+    ('SL',      60, 0x3,        np.uint8),
+    ('MCELL',   57, 0x7,        np.uint8),
+    ('TAGORB',  25, 0xFFFFFFFF, np.uint32),
+    ('TAGBX',   13, 0xFFF,      np.uint16),
+    ('BX',       1, 0xFFF,      np.uint16),
+    ('QUAL',     0, 0x1,        np.uint8),
+]
+TRIGGER_DTYPE = np.dtype([(name, dtype) for name, _, _, dtype in TRIGGER_FIELDS])
+TRIGGER_COLUMNS = list(TRIGGER_DTYPE.names)
+TRIGGER_BX_NULL = 4095        # BX of the null trigger words
+
+# columns of the unpacked files: hit lines have 6 fields, trigger lines 7
+TXT_COLUMNS = HIT_COLUMNS + ['QUAL']
+
+HEAD_HIT_MAX = 2              # words with HEAD <= 2 are hits
+HEAD_TRIGGER = 3              # words with HEAD == 3 are trigger primitives
+CHANNELS_NO_TDC_SHIFT = (137, 138)   # channels whose TDC_MEAS is not corrected by -1
+WORD_DTYPE = np.dtype('<u8')
+UNPACK_BLOCK = 1 << 20        # words unpacked at once, bounds the size of the temporaries
+
+
+def _field(words, first, mask):
+    """Function returning the bit field (words >> first) & mask as uint64"""
+    return (words >> np.uint64(first)) & np.uint64(mask)
+
+
+def unpack(words, block=UNPACK_BLOCK):
+    """Function returning the structured array (HIT_DTYPE) of the hits contained in an array of raw words
+    words is any array-like of 64-bit DMA words (e.g. a memory map of a .dat file)
+    Corrections applied as in run_DMA.c: TDC_CHANNEL+1 for all hits, TDC_MEAS-1 for channels other than 137/138
+    """
+    words = np.asarray(words, dtype=WORD_DTYPE)
+    hits = np.empty(len(words), dtype=HIT_DTYPE)
+    nhits = 0
+    for start in range(0, len(words), block):
+        chunk = words[start:start+block]
+        chunk = chunk[_field(chunk, 62, 0x3) <= HEAD_HIT_MAX]
+        out = hits[nhits:nhits+len(chunk)]
+        for name, first, mask, _ in HIT_FIELDS:
+            if name in ('TDC_CHANNEL', 'TDC_MEAS'):
+                continue
+            out[name] = _field(chunk, first, mask)
+        # channel 0 -> 1 (mask applied after the shift, as in run_DMA.c)
+        channel = (_field(chunk, 49, 0x7FFF) + np.uint64(1)) & np.uint64(0x1FF)
+        out['TDC_CHANNEL'] = channel
+        tdc = _field(chunk, 0, 0x1F).astype(np.int8)
+        tdc -= ((channel != CHANNELS_NO_TDC_SHIFT[0]) & (channel != CHANNELS_NO_TDC_SHIFT[1])).astype(np.int8)
+        out['TDC_MEAS'] = tdc
+        nhits += len(chunk)
+    return hits[:nhits]
+
+
+def unpack_triggers(words, block=UNPACK_BLOCK):
+    """Function returning the structured array (TRIGGER_DTYPE) of the trigger words contained in an array of raw words"""
+    words = np.asarray(words, dtype=WORD_DTYPE)
+    triggers = []
+    for start in range(0, len(words), block):
+        chunk = words[start:start+block]
+        chunk = chunk[_field(chunk, 62, 0x3) == HEAD_TRIGGER]
+        out = np.empty(len(chunk), dtype=TRIGGER_DTYPE)
+        for name, first, mask, _ in TRIGGER_FIELDS:
+            out[name] = _field(chunk, first, mask)
+        triggers.append(out)
+    return np.concatenate(triggers) if triggers else np.zeros(0, dtype=TRIGGER_DTYPE)
+
+
+def map_words(file_path, skip=0, count=-1):
+    """Function returning a read-only memory map of the 64-bit words in a raw .dat file
+    skip  = number of words to skip at the beginning of the file
+    count = maximum number of words to map (-1 for all)
+    A trailing partial word (file still being written) is ignored
+    """
+    nwords = max(0, _file_words(file_path) - skip)
+    if count >= 0:
+        nwords = min(nwords, count)
+    if nwords == 0:
+        return np.zeros(0, dtype=WORD_DTYPE)
+    return np.memmap(file_path, dtype=WORD_DTYPE, mode='r', offset=skip*WORD_DTYPE.itemsize, shape=(nwords,))
+
+
+def _file_words(file_path):
+    """Function returning the number of complete 64-bit words in a file"""
+    return os.path.getsize(file_path) // WORD_DTYPE.itemsize
+
+
+def read_dat(file_path, skip=0, count=-1):
+    """Function returning the structured array of hits unpacked from a raw .dat file"""
+    return unpack(map_words(file_path, skip, count))
+
+
+def read_dat_triggers(file_path, skip=0, count=-1):
+    """Function returning the structured array of trigger words unpacked from a raw .dat file"""
+    return unpack_triggers(map_words(file_path, skip, count))
+
+
+def read_csv(file_path, skip=0, **kwargs):
+    """Function returning the DataFrame (TXT_COLUMNS) of the lines of an unpacked .txt file, hits and triggers
+    skip = number of lines to skip after the header, kwargs are passed to pd.read_csv (e.g. chunksize)
+    The header is skipped rather than parsed, since the trigger lines have one more field than the hit lines
+    """
+    return pd.read_csv(file_path, header=None, names=TXT_COLUMNS, skiprows=range(0, skip+1), **kwargs)
+
+
+def read_txt(file_path, skip=0):
+    """Function returning the structured array of hits read from an unpacked .txt file
+    skip = number of lines to skip after the header
+    A truncated last line (file still being written) is dropped
+    """
+    return csv_to_hits(read_csv(file_path, skip))
+
+
+def csv_to_hits(df):
+    """Function returning the structured array of the hits in a DataFrame read from an unpacked .txt file"""
+    df = df.loc[df['HEAD'] <= HEAD_HIT_MAX, HIT_COLUMNS].dropna()
+    hits = np.empty(len(df), dtype=HIT_DTYPE)
+    for name in HIT_COLUMNS:
+        hits[name] = df[name].values
+    return hits
+
+
+def csv_to_triggers(df):
+    """Function returning the structured array of the trigger words in a DataFrame read from an unpacked .txt file"""
+    df = df.loc[df['HEAD'] == HEAD_TRIGGER, TXT_COLUMNS].dropna()
+    triggers = np.empty(len(df), dtype=TRIGGER_DTYPE)
+    for name, column in zip(TRIGGER_COLUMNS, TXT_COLUMNS):
+        triggers[name] = df[column].values
+    return triggers
+
+
+def read_hits(file_path, skip=0):
+    """Function returning the structured array of hits in a .dat or .txt file"""
+    if file_path.endswith('.dat'):
+        return read_dat(file_path, skip)
+    return read_txt(file_path, skip)
+
+
+def read_hits_triggers(file_path, skip=0):
+    """Function returning the structured arrays (hits, triggers) in a .dat or .txt file, reading it once"""
+    if file_path.endswith('.dat'):
+        words = map_words(file_path, skip)
+        return unpack(words), unpack_triggers(words)
+    df = read_csv(file_path, skip)
+    return csv_to_hits(df), csv_to_triggers(df)
+
+
+def read_triggers(file_path, skip=0):
+    """Function returning the structured array of trigger words in a .dat or .txt file"""
+    if file_path.endswith('.dat'):
+        return read_dat_triggers(file_path, skip)
+    return csv_to_triggers(read_csv(file_path, skip))
+
+
+def to_dataframe(hits):
+    """Function returning a DataFrame with the HIT_COLUMNS of a structured array of hits, keeping the compact dtypes"""
+    return pd.DataFrame({name: hits[name] for name in hits.dtype.names}, columns=list(hits.dtype.names))
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+"""Replay recorded runs on the topics of the online monitor (eventsDataframe, occupancyPlot), at a multiple of the
+real rate, to a Kafka broker or to an in-process transport consumed locally"""
+import os
+import re
+import threading
+import time
+from packages.ingest import expand_inputs, iter_orbit_chunks
+from packages.hitstore import CHUNK_HITS
+from packages.replay import iter_batches, replay, FORMATS, TOPIC_HITS, TOPIC_OCCUPANCY
+from packages.transport import LocalBroker, LocalProducer, LocalConsumer
+from packages.kafkapayload import deserialize, message_columns
+from packages.consumer import BoundedConsumer, POLICIES
+from packages.parallel import cpu_count
+
+# options
+import argparse
+parser = argparse.ArgumentParser(description='Replay the hits of recorded runs on the topics of the online monitor.')
+parser.add_argument('-i', '--input',   metavar='PATH', nargs='+', required=True,                           help='RunNNNNNN folders, data files or hit stores, replayed in order')
+parser.add_argument('-s', '--speed',   action='store', default=1.,      dest='SPEED',  type=float,         help='Multiple of the real rate (0 = as fast as possible)')
+parser.add_argument('-w', '--window',  action='store', default=6.,      dest='WINDOW', type=float,         help='Run time in s of each batch (the read time of the monitor)')
+parser.add_argument('-b', '--brokers', action='store', default='localhost:9092', dest='BROKERS',           help='Kafka bootstrap servers')
+parser.add_argument('-l', '--local',   action='store_true', default=False, dest='LOCAL',                   help='Publish on an in-process transport, consumed and decoded in this process, instead of Kafka')
+parser.add_argument('-f', '--format',  action='store', default='binary', dest='FORMAT', choices=FORMATS,   help='Message format: binary payload or JSON of the columns')
+parser.add_argument('-r', '--run',     action='store', default=None,    dest='RUN',    type=int,           help='Run number in the messages (default: from the RunNNNNNN folder)')
+parser.add_argument('-q', '--queue',   action='store', default=16,      dest='QUEUE',  type=int,           help='Queue size of the local consumer')
+parser.add_argument('-p', '--policy',  action='store', default='block', dest='POLICY', choices=POLICIES,    help='Policy of the local consumer when its queue is full')
+parser.add_argument('-j', '--jobs',    action='store', default=cpu_count(), dest='JOBS', type=int,         help='Number of processes decoding the files')
+parser.add_argument('-v', '--verbose', action='store_true', default=False, dest='VERBOSE',                 help='Print each batch sent')
+args = parser.parse_args()
+
+run = args.RUN
+if run is None:
+  found = re.search(r'Run(\d+)', os.path.abspath(args.input[0]))
+  run = int(found.group(1)) if found else 0
+
+files = expand_inputs(args.input)
+batches = iter_batches(iter_orbit_chunks(files, CHUNK_HITS, processes=args.JOBS), args.WINDOW)
+print('replaying run %d: %d files, batches of %.1f s at %gx real rate, %s messages to %s' %
+      (run, len(files), args.WINDOW, args.SPEED, args.FORMAT, 'the local transport' if args.LOCAL else args.BROKERS))
+
+if not args.LOCAL:
+  from kafka import KafkaProducer
+  producer = KafkaProducer(bootstrap_servers=args.BROKERS)
+  stats = replay(batches, producer, run, args.SPEED, args.FORMAT, args.VERBOSE)
+  producer.close()
+else:
+  # the replay is published from a thread, and consumed here as done by the monitor; all the messages are kept, so
+  # that none is lost before it is consumed
+  broker = LocalBroker(retention=None)
+  consumer = LocalConsumer(broker, 'earliest', value_deserializer=deserialize)
+  consumer.subscribe([TOPIC_OCCUPANCY, TOPIC_HITS])
+  stage = BoundedConsumer(consumer, args.QUEUE, args.POLICY).start()
+  result = {}
+  def publish():
+    result.update(replay(batches, LocalProducer(broker), run, args.SPEED, args.FORMAT, args.VERBOSE))
+    # stop once all the messages have been queued (or sampled out)
+    while stage.stats()['queued'] + stage.stats()['sampled_out'] < result['messages']:
+      time.sleep(0.1)
+    stage.stop()
+  thread = threading.Thread(target=publish)
+  thread.start()
+  received, hits, latency = 0, 0, 0.
+  for message in stage:
+    received += 1
+    latency = max(latency, time.time() - message.timestamp/1000.)
+    if message.topic == TOPIC_HITS:
+      hits += len(message_columns(message.value)['ORBIT_CNT'])
+  thread.join()
+  stats = result
+  print('consumed %d messages, %d hits, max latency %.3f s, %s' %
+        (received, hits, latency, ', '.join('%s %s' % item for item in sorted(stage.stats().items()))))
+
+print('sent %d batches, %d messages, %d hits, %.1f MB in %.1f s (%.0f hits/s), max delay behind schedule %.3f s' %
+      (stats['batches'], stats['messages'], stats['hits'], stats['bytes']/1e6, stats['elapsed'],
+       stats['hits']/stats['elapsed'] if stats['elapsed'] > 0 else 0, stats['delay']))
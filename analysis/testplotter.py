@@ -213,10 +213,11 @@ def meantimer(message):
     timens_h, timens_e = np.histogram(allhits[allhits.SL==theSL].TIMENS, density=False, bins=100, range=(-200,800))
     posx_h, posx_e = np.histogram(allhits[allhits.SL==theSL].TIMENS*VDRIFT, density=False, bins=70, range=(-5,30))
     tdcc_h, tdcc_e = np.histogram(allhits[allhits.SL==theSL].TDC_CHANNEL_NORM, density=False, bins=NCHANNELS, range=(1,NCHANNELS+1))
+    posg_h, posg_ze, posg_xe = np.histogram2d(np.tile(allhits[allhits.SL==theSL].Z_POS, 2), np.concatenate([allhits[allhits.SL==theSL].X_POS_LEFT, allhits[allhits.SL==theSL].X_POS_RIGHT]), bins=(POSG_ZBINS,POSG_XBINS), range=(POSG_ZRANGE,POSG_XRANGE))
 
     tmb_ds[theSL].data.update (**dict(timens_hist=timens_h,timens_ledge=timens_e[:-1],timens_redge=timens_e[1:]))
     posx_ds[theSL].data.update(**dict(posx_hist=posx_h,posx_redge=posx_e[:-1],posx_ledge=posx_e[1:]))
-    posg_ds[theSL].data.update(**dict(xpos_r=allhits[allhits.SL==theSL]['X_POS_RIGHT'].tolist(), xpos_l=allhits[allhits.SL==theSL]['X_POS_LEFT'].tolist(), zpos=allhits[allhits.SL==theSL]['Z_POS'].tolist()))
+    posg_ds[theSL].data.update(**dict(image=[posg_h]))
     posg_last_ds[theSL].data.update(**dict(xpos_r_last=allhits[(allhits.SL==theSL) & (allhits.ORBIT_CNT==(allhits.loc[allhits.SL==theSL]['ORBIT_CNT'].iloc[-1]))]['X_POS_RIGHT'].tolist(), 
 				           xpos_l_last=allhits[(allhits.SL==theSL) & (allhits.ORBIT_CNT==(allhits.loc[allhits.SL==theSL]['ORBIT_CNT'].iloc[-1]))]['X_POS_LEFT'].tolist(),
                                            zpos_last=allhits[(allhits.SL==theSL) & (allhits.ORBIT_CNT==(allhits.loc[allhits.SL==theSL]['ORBIT_CNT'].iloc[-1]))]['Z_POS'].tolist()))